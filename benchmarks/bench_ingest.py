@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+latency benchmark of the live ingest mode (iso_cv/watch.py): synthetic
+camera images (see synthetic.py) are written into a watched directory one
+after the other, the way a camera does (in chunks), while
+watch.ingest_camera processes them. reports the latency of every image -
+from the moment its file is complete until its row is written - and the
+part of it spent in the processing stages (the rest is the wait for the
+file to settle, see watch.DirectoryWatcher).
+
+most of the processing time is the adaptive threshold of the ROI search,
+which grows with the image size - the default det_scale of 0.25 keeps a
+4000 x 3000 image well below a second on a single core, det_scale 1 does
+not.
+
+usage (from the root of the repo):
+
+    python benchmarks/bench_ingest.py [--images 10] [--every 1.5] [--det-scale 1] [--max-latency 1.0]
+
+exits with status 1 if the p90 latency is above --max-latency
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import synthetic
+from iso_cv.control import MODES, ControlWriter
+from iso_cv.watch import ingest_camera
+
+
+def write_slowly(path, data, chunks=8, pause=0.01):
+    # write data to path in chunks, like a camera saving an image
+    step = -(-len(data) // chunks)
+    with open(path, 'wb') as f:
+        for i in range(0, len(data), step):
+            f.write(data[i:i + step])
+            f.flush()
+            time.sleep(pause)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--every", type=float, default=1.5, help="seconds between two images")
+    parser.add_argument("--size", nargs=2, type=int, default=[4000, 3000], help="size of the raw images")
+    parser.add_argument("--threads", type=int, default=2, help="threads per stage")
+    parser.add_argument("--det-scale", type=float, default=0.25, help="det_scale of the camera procedure (see camera.find_roi)")
+    parser.add_argument("--control", choices=MODES, default="full")
+    parser.add_argument("--max-latency", type=float, default=1.0, help="max. p90 latency in seconds")
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix = "iso_cv_ingest_")
+    in_dir, gray_dir, out_dir = [os.path.join(root, d) for d in ("in", "gray", "out")]
+    for d in (in_dir, gray_dir, out_dir):
+        os.makedirs(d)
+    try:
+        # encode the images first, so writing them takes no time
+        frames = []
+        for i in range(args.images):
+            img, truth = synthetic.make_camera_frame(size = tuple(args.size), seed = i)
+            path = os.path.join(root, "frame_%02d.jpg" % i)
+            synthetic.save_jpg(path, img)
+            with open(path, 'rb') as f:
+                frames.append(f.read())
+            os.remove(path)
+
+        written, done = {}, {}
+        stop = threading.Event()
+        control = ControlWriter(args.control)
+
+        def consume():
+            for res in ingest_camera(in_dir, gray_dir, out_dir, os.path.join(out_dir, "camera.txt"),
+                                     dict(det_scale = args.det_scale), n_threads = args.threads, stop = stop, control = control):
+                done[res.item] = (time.perf_counter(), res.latency, res.error)
+
+        consumer = threading.Thread(target = consume)
+        consumer.start()
+        try:
+            for i, data in enumerate(frames):
+                path = os.path.join(in_dir, "frame_%02d.jpg" % i)
+                write_slowly(path, data)
+                written[path] = time.perf_counter()
+                time.sleep(args.every)
+            deadline = time.perf_counter() + 10 * max(args.max_latency, args.every)
+            while len(done) < len(written) and time.perf_counter() < deadline:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            consumer.join()
+            control.close()
+    finally:
+        shutil.rmtree(root, ignore_errors = True)
+
+    print("%-16s %10s %10s %s" % ("image", "latency", "pipeline", ""))
+    latency = []
+    for path in sorted(written):
+        if path not in done:
+            print("%-16s %10s" % (os.path.basename(path), "missing"))
+            latency.append(float('inf'))
+            continue
+        t, pipeline, error = done[path]
+        latency.append(t - written[path])
+        print("%-16s %9.3fs %9.3fs %s" % (os.path.basename(path), latency[-1], pipeline, "FAILED" if error else ""))
+    p50, p90 = np.percentile(latency, 50), np.percentile(latency, 90)
+    print("\nlatency p50 %.3f s, p90 %.3f s (max. %.3f s)" % (p50, p90, args.max_latency))
+    return 0 if p90 <= args.max_latency else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark of the multi-scale ROI detection in iso_cv/camera.py: locates the
+isopod at full resolution (det_scale = 1) and on downsampled images, reports
+the time of the detection step and checks that Length and Area of the final
+measurement match the full resolution pipeline within tolerance.
+
+usage (from the root of the repo):
+
+    python benchmarks/bench_roi.py [gray_dir] --scales 0.5 0.25 --tolerance 0.02
+
+exits with status 1 if any image is outside the tolerance
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from iso_cv import camera
+
+
+def time_find_roi(img, params, repeat):
+    # best of repeat runs
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        key, roi = camera.find_roi(img, params)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def rel_diff(a, b):
+    return abs(a - b) / b if b else float('inf')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("gray_dir", nargs="?", default=os.path.join("examples", "camera", "gray"))
+    parser.add_argument("--scales", nargs="+", type=float, default=[0.5, 0.25])
+    parser.add_argument("--tolerance", type=float, default=0.02, help="max. relative difference of Length and Area")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    files = sorted(f for f in os.listdir(args.gray_dir) if f.lower().endswith(".jpg"))
+    ok = True
+    totals = dict((s, 0.0) for s in [1] + args.scales)
+
+    print("%-40s %6s %10s %8s %8s %8s" % ("image", "scale", "find_roi", "speedup", "Length", "Area"))
+    for f in files:
+        key, img = camera.read_gray(os.path.join(args.gray_dir, f))
+        base = camera.get_params(dict(det_scale = 1))
+        t_full = time_find_roi(img, base, args.repeat)
+        roi, ref = camera.analyse_gray(img, base)
+        totals[1] += t_full
+        if ref is None:
+            print("%-40s no isopod found at full resolution, skipped" % f)
+            continue
+        print("%-40s %6s %9.3fs %8s %8.2f %8.2f" % (f, 1, t_full, "", ref['length'], ref['area']))
+
+        for s in args.scales:
+            params = camera.get_params(dict(det_scale = s))
+            t = time_find_roi(img, params, args.repeat)
+            totals[s] += t
+            roi, rec = camera.analyse_gray(img, params)
+            if rec is None:
+                match = False
+                length = area = float('nan')
+            else:
+                length, area = rec['length'], rec['area']
+                match = rel_diff(length, ref['length']) <= args.tolerance and rel_diff(area, ref['area']) <= args.tolerance
+            ok = ok and match
+            print("%-40s %6s %9.3fs %7.1fx %8.2f %8.2f %s" % ("", s, t, t_full / t, length, area, "" if match else "<- outside tolerance"))
+
+    print("\ntotal find_roi time:")
+    for s in sorted(totals, reverse=True):
+        print("  scale %-5s %8.3fs  (%.1fx)" % (s, totals[s], totals[1] / totals[s] if totals[s] else 0))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+equivalence check and benchmark of the tiled scanner mode (iso_cv/tiles.py):
+a synthetic scan is analysed as a whole (scanner.analyse_scan) and in bands
+of different sizes (scanner.analyse_scan_tiled). both must find the same
+objects with the same measurements. reports time and peak memory (numpy
+and opencv results, via tracemalloc) of both.
+
+usage (from the root of the repo):
+
+    python benchmarks/bench_tiles.py [--size 7016 4961] [--bands 256 512 1024]
+
+exits with status 1 if any result differs
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import synthetic
+from iso_cv import scanner
+from iso_cv.tiles import TiledScan
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def full(path):
+    gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    return scanner.analyse_scan(gray)
+
+
+def tiled(path, band):
+    with TiledScan(path, band) as scan:
+        return scanner.analyse_scan_tiled(scan)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", nargs=2, type=int, default=[7016, 4961], help="width and height of the scan")
+    parser.add_argument("--animals", type=int, default=40)
+    parser.add_argument("--bands", nargs="+", type=int, default=[256, 512, 1024])
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix = "iso_cv_bench_")
+    try:
+        path = os.path.join(tmp, "scan.jpg")
+        img, truth = synthetic.make_scan(n = args.animals, size = tuple(args.size))
+        synthetic.save_jpg(path, img)
+        del img
+
+        ref, t_ref, m_ref = measure(lambda: full(path))
+        ref_rows = [scanner.result_row(rec) for rec in ref]
+        print("%-12s %8s %10s %8s %s" % ("mode", "objects", "time", "memory", "equal"))
+        print("%-12s %8d %9.2fs %6.0fMB" % ("whole scan", len(ref), t_ref, m_ref / 1e6))
+        ok = True
+        for band in args.bands:
+            res, t, m = measure(lambda: tiled(path, band))
+            equal = [scanner.result_row(rec) for rec in res] == ref_rows
+            ok = ok and equal
+            print("%-12s %8d %9.2fs %6.0fMB %s" % ("band %d" % band, len(res), t, m / 1e6, equal))
+    finally:
+        shutil.rmtree(tmp, ignore_errors = True)
+    print("\nall results identical" if ok else "\nRESULTS DIFFER")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark suite - runs the scanner and camera procedures end to end on
+synthetic images (see synthetic.py) and reports
+
+- throughput (images/s) and latency per image (p50, p90)
+- time per stage (from the stage profiler, see iso_cv/profiling.py)
+- peak memory per image (with --memory)
+- accuracy: detection rate, false positives and the mean relative error of
+  Length and Area against the ground truth of the generator
+
+results are compared to the stored baselines (benchmarks/baselines.json),
+and the run fails (exit status 1) if throughput, latency or memory get
+worse by more than --tolerance, or accuracy by more than --acc-tolerance.
+baselines depend on the machine - record them with --update on the machine
+the benchmarks are run on.
+
+usage (from the root of the repo):
+
+    python benchmarks/run.py --preset small
+    python benchmarks/run.py --preset realistic --memory --update
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import synthetic
+from iso_cv import camera, scanner, profiling
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# number of images and generator settings per preset
+PRESETS = dict(
+    small = dict(scans = 2, scan_size = (2400, 1800), animals = 8, frames = 3, frame_size = (4000, 3000)),
+    realistic = dict(scans = 4, scan_size = (7016, 4961), animals = 40, frames = 10, frame_size = (4000, 3000)),
+    )
+
+
+# =============================================================================
+# data
+# =============================================================================
+
+def generate(data_dir, preset, seed=0):
+    """
+    write the synthetic images of a preset to data_dir (scanner/ and
+    camera/) with their ground truth in truth.json - reused if it exists
+    """
+    truth_path = os.path.join(data_dir, "truth.json")
+    if os.path.isfile(truth_path):
+        with open(truth_path) as f:
+            return json.load(f)
+
+    p = PRESETS[preset]
+    truth = dict(scanner = {}, camera = {})
+    for sub in truth:
+        os.makedirs(os.path.join(data_dir, sub), exist_ok=True)
+    for i in range(p['scans']):
+        img, t = synthetic.make_scan(n = p['animals'], size = p['scan_size'], seed = seed + i)
+        name = "scan_%02d.jpg" % i
+        synthetic.save_jpg(os.path.join(data_dir, "scanner", name), img)
+        truth['scanner'][name] = t
+    for i in range(p['frames']):
+        img, t = synthetic.make_camera_frame(size = p['frame_size'], seed = seed + i)
+        name = "frame_%02d.jpg" % i
+        synthetic.save_jpg(os.path.join(data_dir, "camera", name), img)
+        truth['camera'][name] = t
+    with open(truth_path, 'w') as f:
+        json.dump(truth, f)
+    return truth
+
+
+# =============================================================================
+# accuracy
+# =============================================================================
+
+def rel_err(value, ref):
+    return abs(float(value) - ref) / ref
+
+
+def match(found, truth, max_dist):
+    """
+    match found objects (dicts with X, Y, Length, Area) to the ground truth
+    by nearest position. returns (matched pairs, number of false positives)
+    """
+    pairs, used = [], set()
+    for t in truth:
+        best, best_d = None, max_dist
+        for j, f in enumerate(found):
+            d = np.hypot(f['X'] - t['X'], f['Y'] - t['Y'])
+            if j not in used and d <= best_d:
+                best, best_d = j, d
+        if best is not None:
+            used.add(best)
+            pairs.append((found[best], t))
+    return pairs, len(found) - len(used)
+
+
+def accuracy(pairs, n_truth, false_pos):
+    length = [rel_err(f['Length'], t['Length']) for f, t in pairs]
+    area = [rel_err(f['Area'], t['Area']) for f, t in pairs]
+    return dict(
+        detection_rate = len(pairs) / n_truth if n_truth else 1.0,
+        false_positives = false_pos,
+        length_err = float(np.mean(length)) if length else 1.0,
+        area_err = float(np.mean(area)) if area else 1.0,
+        )
+
+
+# =============================================================================
+# cases
+# =============================================================================
+
+def run_scanner(data_dir, out_dir, truth, profiler, params=None):
+    pairs, false_pos, n_truth = [], 0, 0
+    for name in sorted(truth):
+        with profiling.activate(profiler), profiler.image(name):
+            rows = scanner.process_scan(os.path.join(data_dir, "scanner", name), out_dir, params)
+        found = [dict(X = r[1], Y = r[2], Length = r[3], Area = r[4]) for r in rows]
+        p, fp = match(found, truth[name], max_dist = 50)
+        pairs.extend(p)
+        false_pos += fp
+        n_truth += len(truth[name])
+    return accuracy(pairs, n_truth, false_pos)
+
+
+def run_scanner_labels(data_dir, out_dir, truth, profiler):
+    # scanner with the label image engine (scanner.measure_labels)
+    return run_scanner(data_dir, out_dir, truth, profiler, dict(engine = "labels"))
+
+
+def run_camera(data_dir, out_dir, truth, profiler):
+    pairs, false_pos = [], 0
+    for name in sorted(truth):
+        with profiling.activate(profiler), profiler.image(name):
+            gray_name = camera.normalize_file(os.path.join(data_dir, "camera", name), out_dir)
+            key, img = camera.read_gray(os.path.join(out_dir, gray_name))
+            roi, rec = camera.analyse_gray(img)
+        if rec is None or rec['mean'] is None:
+            continue
+        pairs.append((dict(Length = rec['length'], Area = rec['area']), truth[name]))
+    return accuracy(pairs, len(truth), false_pos)
+
+
+def run_case(func, data_dir, truth, memory):
+    out_dir = tempfile.mkdtemp(prefix = "iso_cv_bench_")
+    profiler = profiling.Profiler(memory = memory)
+    try:
+        start = time.perf_counter()
+        acc = func(data_dir, out_dir, truth, profiler)
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_dir, ignore_errors = True)
+
+    totals = [r for r in profiler.records if r['stage'] == "total"]
+    latency = np.array([r['wall'] for r in totals])
+    peaks = [r['peak'] for r in totals if r['peak'] is not None]
+    result = dict(
+        images = len(totals),
+        seconds = seconds,
+        images_per_s = len(totals) / seconds,
+        latency_p50 = float(np.percentile(latency, 50)),
+        latency_p90 = float(np.percentile(latency, 90)),
+        peak_memory = max(peaks) if peaks else None,
+        stages = dict((s['stage'], s['wall_total']) for s in profiler.summary() if s['stage'] != "total"),
+        )
+    result.update(acc)
+    return result
+
+
+# =============================================================================
+# baselines
+# =============================================================================
+
+def compare(result, base, tol, acc_tol):
+    # list of regressions of result against a baseline entry
+    problems = []
+    if result['images_per_s'] < base['images_per_s'] * (1 - tol):
+        problems.append("throughput %.3f < %.3f images/s" % (result['images_per_s'], base['images_per_s']))
+    if result['latency_p90'] > base['latency_p90'] * (1 + tol):
+        problems.append("p90 latency %.3f > %.3f s" % (result['latency_p90'], base['latency_p90']))
+    if result['peak_memory'] and base.get('peak_memory') and result['peak_memory'] > base['peak_memory'] * (1 + tol):
+        problems.append("peak memory %d > %d bytes" % (result['peak_memory'], base['peak_memory']))
+    if result['detection_rate'] < base['detection_rate'] - acc_tol:
+        problems.append("detection rate %.3f < %.3f" % (result['detection_rate'], base['detection_rate']))
+    for key in ('length_err', 'area_err'):
+        if result[key] > base[key] + acc_tol:
+            problems.append("%s %.3f > %.3f" % (key, result[key], base[key]))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="small")
+    parser.add_argument("--cases", nargs="+", choices=["scanner", "scanner_labels", "camera"], default=["scanner", "camera"],
+                        help="scanner_labels: the scanner with the label image engine (not run by default)")
+    parser.add_argument("--data", help="directory for the synthetic images (default: temporary, removed afterwards)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--memory", action="store_true", help="record peak memory (slower)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative loss of throughput, latency and memory")
+    parser.add_argument("--acc-tolerance", type=float, default=0.01, help="allowed increase of the relative Length/Area error")
+    parser.add_argument("--max-error", type=float, default=0.15, help="max. mean relative Length/Area error against the ground truth")
+    parser.add_argument("--update", action="store_true", help="store the results as new baselines")
+    parser.add_argument("--report", help="write the results as json to this file")
+    args = parser.parse_args(argv)
+
+    data_dir = args.data or tempfile.mkdtemp(prefix = "iso_cv_data_")
+    try:
+        truth = generate(data_dir, args.preset, args.seed)
+        funcs = dict(scanner = run_scanner, scanner_labels = run_scanner_labels, camera = run_camera)
+        results = {}
+        for case in args.cases:
+            results[args.preset + "/" + case] = run_case(funcs[case], data_dir, truth[case.split("_")[0]], args.memory)
+    finally:
+        if not args.data:
+            shutil.rmtree(data_dir, ignore_errors = True)
+
+    baselines = {}
+    if os.path.isfile(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+
+    ok = True
+    for name, r in sorted(results.items()):
+        print("\n%s: %d images in %.2f s - %.3f images/s, latency p50 %.3f s, p90 %.3f s%s" % (
+            name, r['images'], r['seconds'], r['images_per_s'], r['latency_p50'], r['latency_p90'],
+            ", peak memory %.1f MB" % (r['peak_memory'] / 1e6) if r['peak_memory'] else ""))
+        for stage, seconds in sorted(r['stages'].items(), key=lambda s: -s[1]):
+            print("    %-20s %8.3f s" % (stage, seconds))
+        print("  accuracy: detection rate %.3f, false positives %d, Length error %.3f, Area error %.3f" % (
+            r['detection_rate'], r['false_positives'], r['length_err'], r['area_err']))
+
+        if r['length_err'] > args.max_error or r['area_err'] > args.max_error:
+            print("  FAILED: error against ground truth above %.3f" % args.max_error)
+            ok = False
+        if name in baselines and not args.update:
+            problems = compare(r, baselines[name], args.tolerance, args.acc_tolerance)
+            for problem in problems:
+                print("  REGRESSION: " + problem)
+            ok = ok and not problems
+        elif not args.update:
+            print("  (no baseline)")
+
+    if args.update:
+        baselines.update(results)
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print("\nbaselines written to " + BASELINES)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+synthetic test images - isopod-like blobs (elliptic body, legs, antennae)
+rendered onto scanner- and camera-style backgrounds, together with their
+ground truth (position, Length and Area in mm).
+
+the body is what the procedures are supposed to measure: Length is the
+long axis of the body ellipse, Area its area. legs and antennae are thinner
+and paler than the body (like in the example images), so the thresholds and
+opening kernels of the procedures remove them.
+"""
+
+import math
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def _pt(v):
+    return (int(round(v[0])), int(round(v[1])))
+
+
+def draw_isopod(img, center, length, width, angle, gray, rng, legs=True, leg_gray=None):
+    """
+    draw one isopod into img (in place): body ellipse of length x width
+    pixels, rotated by angle (degrees), 7 pairs of legs and 2 antennae
+    (of gray value leg_gray, default: like the body)
+    """
+    c = np.array(center, dtype=float)
+    t = math.radians(angle)
+    u = np.array([math.cos(t), math.sin(t)]) # long axis
+    v = np.array([-math.sin(t), math.cos(t)]) # short axis
+    thick = max(1, int(width / 20))
+    leg_gray = gray if leg_gray is None else leg_gray
+
+    if legs:
+        for k in range(7):
+            along = (-0.35 + 0.7 * k / 6) * length
+            for side in (-1, 1):
+                base = c + along * u + side * (width / 2 - thick) * v
+                tip = base + side * 0.45 * width * v + rng.uniform(-0.05, 0.05) * length * u
+                cv2.line(img, _pt(base), _pt(tip), leg_gray, thick, cv2.LINE_AA)
+        for side in (-1, 1):
+            base = c + 0.48 * length * u + side * 0.15 * width * v
+            tip = base + 0.3 * length * u + side * 0.25 * length * v
+            cv2.line(img, _pt(base), _pt(tip), leg_gray, max(1, thick // 2), cv2.LINE_AA)
+
+    cv2.ellipse(img, _pt(c), (int(round(length / 2)), int(round(width / 2))), angle, 0, 360, gray, -1, cv2.LINE_AA)
+
+
+def _background(size, level, gradient, rng, power=1):
+    # smooth brightness gradient (vignetting) around level - gradient darker
+    # (negative: brighter) at the corners, power shapes the fall-off
+    w, h = size
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    r = np.hypot((xx - w / 2) / w, (yy - h / 2) / h)
+    return level - gradient * (r / r.max())**power
+
+
+def _finish(img, noise, rng):
+    # add sensor noise and convert to 8 bit
+    if noise:
+        img = img + rng.normal(0, noise, img.shape).astype(np.float32)
+    return np.clip(np.round(img), 0, 255).astype(np.uint8)
+
+
+def make_scan(n=30, size=(7016, 4961), scale=94.6876, length_mm=(2, 10), aspect=(0.35, 0.5),
+              background=215, contrast=(100, 170), leg_contrast=0.5, gradient=15, noise=4, seed=0):
+    """
+    flatbed scan with n isopods (default: A4 at 600 dpi). returns the gray
+    image and the ground truth - a list of dicts with X, Y (pixels), Length
+    and Area (mm, mm^2). animals don't overlap
+    """
+    rng = np.random.RandomState(seed)
+    img = _background(size, background, gradient, rng)
+    truth = []
+    placed = []
+    for i in range(n * 20):
+        if len(truth) == n:
+            break
+        length = rng.uniform(*length_mm) * scale
+        width = length * rng.uniform(*aspect)
+        reach = 0.8 * length + 20 # body plus legs and antennae
+        x, y = rng.uniform(reach, size[0] - reach), rng.uniform(reach, size[1] - reach)
+        if any(math.hypot(x - px, y - py) < reach + pr for px, py, pr in placed):
+            continue
+        placed.append((x, y, reach))
+        c = rng.uniform(*contrast)
+        draw_isopod(img, (x, y), length, width, rng.uniform(0, 180), float(background - c), rng,
+                    leg_gray = float(background - leg_contrast * c))
+        truth.append(dict(X = x, Y = y, Length = length / scale,
+                          Area = math.pi * (length / 2) * (width / 2) / scale**2))
+    return _finish(img, noise, rng), truth
+
+
+def make_camera_frame(size=(4000, 3000), scale=140, length_mm=(2, 7), aspect=(0.35, 0.5),
+                      background=225, contrast=(40, 90), leg_contrast=0.5, gradient=-40, power=4, noise=1, glare=3, seed=0):
+    """
+    camera-stand image with a single isopod near the center (scale in pixels
+    per mm of the raw image). like in the example images, the background is
+    flat in the middle and gets brighter towards the corners, which are
+    blown out. a few blown-out reflections (255) are added, away from the
+    isopod.
+    returns the gray image and the ground truth (dict with X, Y in pixels,
+    Length and Area in mm, mm^2)
+    """
+    rng = np.random.RandomState(seed)
+    img = _background(size, background, gradient, rng, power)
+    length = rng.uniform(*length_mm) * scale
+    width = length * rng.uniform(*aspect)
+    x = size[0] / 2 + rng.uniform(-0.15, 0.15) * size[0]
+    y = size[1] / 2 + rng.uniform(-0.15, 0.15) * size[1]
+    placed = 0
+    while placed < glare:
+        gx, gy = rng.uniform(0, size[0]), rng.uniform(0, size[1])
+        if math.hypot(gx - x, gy - y) > 0.25 * max(size):
+            cv2.circle(img, (int(gx), int(gy)), int(rng.uniform(10, 60)), 255.0, -1)
+            placed += 1
+    c = rng.uniform(*contrast)
+    draw_isopod(img, (x, y), length, width, rng.uniform(0, 180), float(background - c), rng,
+                leg_gray = float(background - leg_contrast * c))
+    truth = dict(X = x, Y = y, Length = length / scale,
+                 Area = math.pi * (length / 2) * (width / 2) / scale**2)
+    return _finish(img, noise, rng), truth
+
+
+def save_jpg(path, img, date="2017:06:25 12:00:00", quality=95):
+    """
+    save as jpeg with an exif capture date (tag 306), like camera images
+    """
+    exif = Image.Exif()
+    exif[306] = date
+    if img.ndim == 2:
+        pil = Image.fromarray(img, "L")
+    else:
+        pil = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    pil.save(path, quality=quality, exif=exif.tobytes())
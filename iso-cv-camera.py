@@ -1,24 +1,25 @@
 # -*- coding: utf-8 -*-
 """
 Created: 2017/10/25
-Last Update: 2023/05/09
-Version 0.1.10
+Last Update: 2026/10/18
+Version 0.2.0
 @author: Moritz Lürig
 """
 
 #%% import packages
 
-import cv2
 import os
-import copy
-import numpy as np
-import numpy.ma as ma
-from collections import Counter
-import fileinput
-from PIL import Image
 
-def get_picture_date(path):                           # extracts dates from pictures
-    return Image.open(path).getexif().get(306)
+from iso_cv.batch import run_batch
+from iso_cv.cache import open_cache
+from iso_cv.camera import normalize_file, read_gray, analyse_gray, result_row, control_image, COLUMNS
+from iso_cv.control import ControlWriter
+from iso_cv.manifest import Manifest
+from iso_cv.metadata import MetadataIndex
+from iso_cv.profiling import Profiler, Progress, NULL_PROFILER, activate, stage
+from iso_cv.results import open_sink
+from iso_cv.sweep import sweep
+from iso_cv.watch import ingest_camera
 
 
 #%% directories
@@ -32,8 +33,9 @@ def get_picture_date(path):                           # extracts dates from pict
 # out_dir = "out" # output directory with control images and text files
 # main = os.path.join(os.getcwd(),"examples", "camera") # folders are inside a main working directory
 
-# CHOOSE YOU WORKING DIRECTORY (ROOT OF THE DOWNLOADED ISO_CV REPO)
-os.chdir(r"D:\git-repos\mluerig\iso_cv")
+# CHOOSE YOU WORKING DIRECTORY (ROOT OF THE DOWNLOADED ISO_CV REPO) - only when the script is run, not when it is imported (e.g. by worker processes, which start in the same directory)
+if __name__ == "__main__":
+    os.chdir(r"D:\git-repos\mluerig\iso_cv")
 
 # SUBDIRS
 in_dir = r"examples\camera\in" # directory with raw files 
@@ -47,43 +49,51 @@ for folder in [gray_dir, out_dir]:
 
 
 
- #%% adjust grayscale
+#%% adjust grayscale
          
 ref = 240 # set reference value, depending on your brightness. can be arbitrary depending on your overall background. all images will have their histograms adjusted to this value
+n_workers = None # number of worker processes (None = all cores, 1 = no parallel processing)
 
-for root, dirs, files in os.walk(os.path.join(in_dir)):
-    for i in os.listdir(root):     
-        if i.endswith(".jpg") or i.endswith(".JPG"):
-            
-            label = os.path.splitext(i)[0]
-            date = get_picture_date(os.path.join(root, i))
-            date = date[0:4] + date[5:7] + date[8:10]
-            
-            new_img_name = label + "_" + date + "_gray" + ".jpg"
-                        
-    # read imgs, check if exists to prevent overwriting
-            if not os.path.isfile(os.path.join(gray_dir, new_img_name)):
-                img = cv2.imread(os.path.join(root, i),0)
+# time (wall and cpu) of every processing stage of every image, summarised in run reports (out_dir/profile_gray.json and profile_phenotyping.json). progress shows images/s and the remaining time
+profile = False
+profile_memory = False # also record peak memory per stage (slower)
+progress = False
+
+# finished images are recorded in a manifest (by content and modification time of the raw file), so re-runs skip them and an interrupted run continues where it stopped. images whose gray image was deleted are made again
+# the guard keeps worker processes (which re-import this file on windows) from starting the procedure themselves
+# capture date and size of all raw images are read from their headers only (in parallel) and kept in an index (out_dir/metadata.json) - on re-runs, unchanged files are not read at all
+if __name__ == "__main__":
+    manifest = Manifest(os.path.join(out_dir, "gray_manifest.json"), output_dir = gray_dir)
+    index = MetadataIndex(os.path.join(out_dir, "metadata.json"))
+    images = index.scan(in_dir, extensions = (".jpg",))
+    for date, paths in sorted(index.by_date(images).items()):
+        print(date, len(paths), "images")
     
-    # reduce resolution by 50% - important if you have a lot of images
-                img = cv2.resize(img, (0,0), fx=0.5, fy=0.5) 
-                
-    # threshold and collapse pixels into vector 
-                ret,thresh_img = cv2.threshold(img,245,0,cv2.THRESH_TOZERO_INV)
-                erosion = cv2.erode(thresh_img,np.ones((7,7), np.uint8),iterations = 5)
-                vec = np.ravel(erosion[np.nonzero(erosion)])
-                
-    # find most common grayscale values in vector
-                mc = Counter(vec).most_common(9)
-                g = [item[0] for item in mc]
-                med = np.median(g)
-                
-    # correct picture by subtraction or addition from reference (240)
-                img_corr = img - (med-ref)
-                print(new_img_name)
-                
-    # save adjusted image
-                cv2.imwrite(os.path.join(gray_dir, new_img_name), img_corr)
+    todo, keys = [], []
+    for entry in images:
+        key = manifest.key(entry['path'])
+        if not manifest.is_done(entry['path'], key):
+            todo.append(entry['path'])
+            keys.append(key)
+
+    profiler = Profiler()
+    bar = Progress(len(todo)) if progress else None
+
+    # images are read, resized (50%), histogram adjusted and saved by iso_cv/camera.py - a failing image does not stop the others
+    for res, key in zip(run_batch(normalize_file, todo, n_workers = n_workers, args = (gray_dir, ref),
+                                  profile = profile and ("memory" if profile_memory else True)), keys):
+        profiler.add(res.profile)
+        if res.error:
+            print("FAILED: " + res.item + "\n" + res.error)
+        else:
+            manifest.mark_done(res.item, res.value, key)
+            if not bar:
+                print(res.value)
+        if bar:
+            bar.update()
+    manifest.save()
+    if profile:
+        profiler.save(os.path.join(out_dir, "profile_gray.json"))
     
     
 #%% set detection and phenotyping parameters
@@ -92,6 +102,7 @@ for root, dirs, files in os.walk(os.path.join(in_dir)):
 # (i) OBJECT DETECTION - find ROIs in image 
             
 roi_area = 400 # ROI area (size n x n pixels)                
+det_scale = 1 # locate the isopod on an image downsampled by this factor (e.g. 0.25 is much faster, only the ROI is processed at full resolution - see benchmarks/bench_roi.py)
 det_val = 799 # lower = lower sensitivity (e.g. if extremities are too clearly visible)
 det_it = 3 # higher = removes more noise from the picture, but also cuts pixels of objects
 
@@ -112,125 +123,121 @@ rec_it_close = 3 # closing iteratiuons
 rec_kern_open = (9,9) # opening kernel size (how many pixels are removed from border)
 rec_it_open = 6 # opening iteratiuons
 
+scale = 70 # pick right scale (in this case: 70 pixels = 1 mm)
+
 ## (iii) OUTPUT TEXT FILE
-if not os.path.isfile(os.path.join(out_dir, 'camera.txt')):
-    res_file = open(os.path.join(out_dir, 'camera.txt'), 'w')
-    res_file.write("Source_file" + "\t" + 'Length' +'\t' + 'Area'+ '\t'+ 'Mean'+ '\t'+  'StdDev'+ "\t" + "Scale" + '\n')
-    res_file.close()
+# results are kept in one table (.txt, .csv, .parquet, .feather or .sqlite) with one row per image - rows of images that are processed again are replaced
+res_path = os.path.join(out_dir, 'camera.txt')
+
+## (iv) CACHE
+# intermediate images (gray image, threshold mask, detection, opening, ROI) can be cached on disk - after changing a parameter only the steps that depend on it are recomputed
+cache_dir = None # e.g. os.path.join(out_dir, "cache"), None = no cache
+cache_size = 2 * 1024**3 # max. size of the cache in bytes (least recently used images are removed first)
+
+## (v) CONTROL IMAGES
+# ROI with contour and circle, saved to out_dir in the background while the next image is analysed. "full" = every image, "thumbnail" = every image at control_scale of its size, "sampled" = every control_every-th image plus all flagged ones (no isopod found, or outside control_flag), "off" = none
+control_mode = "full"
+control_every = 10
+control_scale = 0.25
+control_flag = None # e.g. Outlier("length", 1, 8) - length outside 1 - 8 mm (from iso_cv.control import Outlier)
+
+params = dict(
+    roi_area = roi_area,
+    det_scale = det_scale,
+    det_val = det_val,
+    det_it = det_it,
+    det_kern_close = det_kern_close,
+    det_it_close = det_it_close,
+    det_kern_open = det_kern_open,
+    det_it_open = det_it_open,
+    rec_val = rec_val,
+    rec_it = rec_it,
+    rec_kern_close = rec_kern_close,
+    rec_it_close = rec_it_close,
+    rec_kern_open = rec_kern_open,
+    rec_it_open = rec_it_open,
+    scale = scale,
+    )
     
     
 #%% phenotyping procedure
+# the procedure (i - find ROI, ii - work with ROI) lives in iso_cv/camera.py
 
-for i in os.listdir(gray_dir):
-    
-    # pick right scale (in this case: 70 pixels = 1 mm)
-    scale = 70
-    
-    # read images
-    if all([not os.path.isfile(os.path.join(out_dir,"good", i)),
+# worker processes (see above) re-import this file - they get no images, so the procedure only runs in the main process
+files = [i for i in os.listdir(gray_dir) if __name__ == "__main__" and all([os.path.isfile(os.path.join(gray_dir, i)), 
+    not os.path.isfile(os.path.join(out_dir,"good", i)),
     not os.path.isfile(os.path.join(out_dir,"redone", i)),
-    ]):
+    ])]
+results = open_sink(res_path, COLUMNS, key = "Source_file")
+cache = open_cache(cache_dir, cache_size)
+control = ControlWriter(control_mode, every = control_every, flag = control_flag, scale = control_scale)
+profiler = Profiler(memory = profile_memory) if profile else NULL_PROFILER
+bar = Progress(len(files)) if progress else None
 
+for i in files:
+    with activate(profiler), profiler.image(i):
+    
+        # if first run, create ROI, else take redo-chunk:
         if os.path.isfile(os.path.join(gray_dir,"redo", i)):
-            img = cv2.imread(os.path.join(gray_dir,"redo", i),0)
+            key, img = read_gray(os.path.join(gray_dir,"redo", i), cache)
             first = False
         else:
-            img = cv2.imread(os.path.join(gray_dir, i),0)
+            key, img = read_gray(os.path.join(gray_dir, i), cache)
             first = True
+            
+        roi, rec = analyse_gray(img, params, first, cache, key)
 
-# =============================================================================
-# i) find ROI in image
-# =============================================================================
-        
-        # if first run, create ROI, else take redo-chunk:
+        # continue ONLY make files IF countour exists, otherwise don't add line to text file BUT make image
+        with stage("results"):
+            if rec:
+                results.write(result_row(i, rec, params))
+        with stage("control_image"):
+            control.submit(os.path.join(out_dir, i), control_image, roi, rec, flagged = rec is None or control.flagged(rec))
+    if bar:
+        bar.update()
+    else:
+        print(i)
         
-        ret,thresh_img = cv2.threshold(img,245,0,cv2.THRESH_TOZERO_INV)
-        np.place(thresh_img, thresh_img > 0, 255)
+control.close()
+results.close()
+if profile and files:
+    profiler.save(os.path.join(out_dir, "profile_phenotyping.json"))
 
-        dilation = cv2.dilate(thresh_img,np.ones((9,9),np.uint8),iterations = 3)
-        erosion = cv2.erode(dilation,np.ones((51,51), np.uint8),iterations = 10)
-        
-        if first == True:
-            morph = cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY_INV,det_val,det_it)
-            morph =  ma.array(data = morph, mask = np.logical_not(erosion)).filled(0)
-            morph = cv2.morphologyEx(morph,cv2.MORPH_CLOSE,np.ones((det_kern_close),np.uint8), iterations = det_it_close)
-            
-            morph1 = cv2.morphologyEx(morph,cv2.MORPH_OPEN,np.ones((det_kern_open),np.uint8), iterations = det_it_open)
-            ret, contours1, hierarchy = cv2.findContours(copy.deepcopy(morph1),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_TC89_L1)
-                       
-            # create ROI
-            areas = []
-            if contours1:
-                for c in contours1:
-                    areas.append(cv2.contourArea(c))
-                largest = contours1[np.argmax(areas)]
-            else:
-                ret, contours, hierarchy = cv2.findContours(copy.deepcopy(morph),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_TC89_L1)
-                for c in contours:
-                    areas.append(cv2.contourArea(c))
-                largest = contours[np.argmax(areas)]
-                
-            (x,y),radius = cv2.minEnclosingCircle(largest)
-            x = int(x)
-            y = int(y)
-            q=roi_area
-            roi = img[max(0,y-q):y+q,max(0,x-q):x+q]   # img[y-400:y+400, x-400:x+400] 
-        else:
-            roi = img
-            
-# =============================================================================
-# ii) work with ROI
-# =============================================================================
-            
-        morph2 = cv2.adaptiveThreshold(roi,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY_INV,rec_val,rec_it)
-        morph2 = cv2.morphologyEx(morph2,cv2.MORPH_CLOSE,np.ones((rec_kern_close),np.uint8), iterations = rec_it_close)
-        morph2 = cv2.morphologyEx(morph2,cv2.MORPH_OPEN,cv2.getStructuringElement(cv2.MORPH_CROSS,rec_kern_open), iterations = rec_it_open)
-        ret2, contours2, hierarchy2 = cv2.findContours(copy.deepcopy(morph2),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_TC89_L1)    
     
-        # continue ONLY make files IF countour exists, otherwise don't add line to text file BUT make image
-        if contours2: 
-            areas2 = [cv2.contourArea(cnt) for cnt in contours2]  # list of contours in ROI
-            largest2 = contours2[np.argmax(areas2)]               # largest contour in ROI
-        
-        # combine contours from multiple detection procedures
-        # conc = np.concatenate((largest1, largest2), axis=0)
-            conc = largest2
-
-            ##### step 3 - create masked array and do algebra on area #####
-            mask = np.zeros_like(roi) # Create mask where white is what we want, black otherwise
-            mask = cv2.drawContours(mask, [conc], 0, 255, -1) # Draw filled contour in mask
-            mask = cv2.erode(mask,np.ones((5,5),np.uint8),iterations = 1)
-            masked =  ma.array(data = roi, mask = np.logical_not(mask))
-        
-            (x,y),radius = cv2.minEnclosingCircle(conc)
-            radius = int(radius)
-            length = round((radius * 2)/scale,2)
-            
-            try:
-                mean = int(np.mean(masked))
-                sd = round(float(np.std(masked)),2)
-                area = round((cv2.contourArea(conc)/scale)/scale,2)
-            except:
-                pass
-            
-            ##### step 4 - write to files #####
-            res_string =  i + "\t" + str(length) + "\t" + str(area) + "\t" + str(mean) + "\t" + str(sd) + "\t" + str(scale) + "\n"
-
-            if i in open(os.path.join(out_dir, 'camera.txt'), "r").read():
-                for line in fileinput.input(os.path.join(out_dir, 'camera.txt'), inplace=1, backup='.bak'):
-                    if i in line:
-                        print(res_string, end="")
-                    else:
-                        print(line, end="")
+#%% live ingest (optional)
+# for images that arrive during an experiment: watches in_dir and runs every new image through both steps above (gray image, ROI, measurement, control image) as soon as the camera has finished writing it. runs until you stop it (ctrl+c). images that were processed before are skipped (same manifest as above). an image is taken once its size has not changed for a moment and it ends like a complete jpeg. to get the results within a second of an image arriving, locate the isopod on a downsampled image (det_scale above, e.g. 0.25) - see benchmarks/bench_ingest.py
+
+run_ingest = False # set to True to start watching
+ingest_threads = 2 # threads per step (gray scale, phenotyping)
+
+if __name__ == "__main__" and run_ingest:
+    control = ControlWriter(control_mode, every = control_every, flag = control_flag, scale = control_scale)
+    try:
+        for res in ingest_camera(in_dir, gray_dir, out_dir, res_path, params, ref, n_threads = ingest_threads, control = control):
+            if res.error:
+                print("FAILED: " + res.item + "\n" + res.error)
             else:
-                with open(os.path.join(out_dir, 'camera.txt'), "a") as res_file:
-                    print(res_string, end="", file = res_file)
-            
-            roi = cv2.cvtColor(roi, cv2.COLOR_GRAY2BGR)
-            roi = cv2.circle(roi,(int(x),int(y)), radius,(255,0,0),2)
-            roi = cv2.drawContours(roi, [largest2], 0, (0,0,255), 2)  
-        cv2.imwrite(os.path.join(out_dir, i), roi)  
-        print(i)
+                print("%s (%.2f s)" % (res.value, res.latency))
+    except KeyboardInterrupt:
+        pass
+    control.close()
+
+    
+#%% parameter sweep (optional)
+# tries combinations of the parameters above against reference measurements (e.g. a copy of camera.txt that has been checked by hand) and reports the fastest setting that is within tolerance. each image is decoded about once per worker process
+
+run_sweep = False # set to True to run the sweep
+sweep_space = dict(det_val = [599, 799, 999], rec_it_open = [4, 6, 8]) # parameters and values to try (all combinations)
+sweep_reference = None # required: table with hand-checked measurements, e.g. a corrected copy of camera.txt saved under a different name (the table written above would only score the current parameters against themselves)
+sweep_tolerance = 0.05 # max. mean relative error of length and area
+
+if __name__ == "__main__" and run_sweep:
+    if sweep_reference is None:
+        raise ValueError("set sweep_reference to a table with hand-checked measurements")
+    report, best = sweep("camera", sweep_space, gray_dir, sweep_reference, tolerance = sweep_tolerance, base_params = params, n_workers = n_workers)
+    for r in report:
+        print(r['config'], "time: %.2f s, length error: %.3f, area error: %.3f" % (r['seconds'], r['length_err'], r['area_err']))
+    print("fastest setting within tolerance:", best['config'] if best else None)
 
     
 #%% redo bad detections 
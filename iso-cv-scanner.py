@@ -1,24 +1,27 @@
 # -*- coding: utf-8 -*-
 """
 Created: 2016/03/31
-Last Update: 2023/05/09
-Version 0.1.4
+Last Update: 2026/10/18
+Version 0.2.0
 @author: Moritz Lürig
 """
 
 #%% import packages
 
-import cv2
 import os
-import numpy as np
-import numpy.ma as ma
-import copy
-import math
+
+from iso_cv.batch import run_batch
+from iso_cv.control import ControlWriter
+from iso_cv.profiling import Profiler, Progress
+from iso_cv.results import open_sink
+from iso_cv.scanner import process_scan, COLUMNS
+from iso_cv.sweep import sweep
         
 #%% directories
 
-# CHOOSE YOU WORKING DIRECTORY (ROOT OF THE DOWNLOADED ISO_CV REPO)
-os.chdir(r"D:\git-repos\mluerig\iso_cv")
+# CHOOSE YOU WORKING DIRECTORY (ROOT OF THE DOWNLOADED ISO_CV REPO) - only when the script is run, not when it is imported (e.g. by worker processes, which start in the same directory)
+if __name__ == "__main__":
+    os.chdir(r"D:\git-repos\mluerig\iso_cv")
 
 # SUBDIRS
 in_dir = "examples\scanner\in" # directory with raw files 
@@ -50,134 +53,98 @@ rec_it_close_fac = 1
 rec_kern_open_fac = 1
 rec_it_open_fac = 1
 
-
-#%% procedure
-    
-# all steps are repeated for each image
-for i in os.listdir(in_dir):
-    if os.path.isfile(os.path.join(in_dir, i)):
-        
-# make separate text-file for each image, write to out_dir
-        res_file = open(os.path.join(out_dir,  i[0:len(i)-4] + '.txt'), 'w')
-        res_file.write('PyLabel' + '\t' + 'X' + '\t'+  'Y'+ '\t'+  'Length'+ '\t'+ 'Area'+ '\t'+ 'Mean'+ '\t'+  'StdDev'+ '\t'+  'Min'+ '\t'+  'Max' + '\n')
-        res_file.close()
-        
-# load image and convert to grayscale
-        img = cv2.imread(os.path.join(in_dir, i))
-        gray = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-        
-# =============================================================================
-# i) find ROIs in image
-# =============================================================================
-        
-# tresholding image - (adaptive thresholding for camera images, or Otsu's binarization for scanned isopods - https://docs.opencv.org/3.0-beta/doc/py_tutorials/py_imgproc/py_thresholding/py_thresholding.html)       
-        ret, thresh = cv2.threshold(gray,0,255,cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
-        #thresh = cv2.adaptiveThreshold(gray,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY_INV,299,9)
-
-# cleanup - "closing operation" with rectangle-shaped kernel, "opening operation" with cross-shaped kernel - good for removing legs (https://docs.opencv.org/3.0-beta/doc/py_tutorials/py_imgproc/py_morphological_ops/py_morphological_ops.html)
-        kernel1 = cv2.getStructuringElement(cv2.MORPH_RECT,det_kern_close)
-        kernel2 = cv2.getStructuringElement(cv2.MORPH_CROSS,det_kern_open)
-        morph1 = cv2.morphologyEx(thresh,cv2.MORPH_CLOSE,kernel1, iterations = det_it_close)
-        morph2 = cv2.morphologyEx(morph1,cv2.MORPH_OPEN,kernel2, iterations = det_it_open)
-
-# find contours 
-        ret, contours, hierarchy = cv2.findContours(copy.deepcopy(morph2),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_TC89_L1)
-
-# loop through all contours in image
-        idx = 0
-        #rows = list()
-        for cnt in contours:
-            
-# exclude small contours (fewer than 50 points - isopods are complex structures that will a lot of points - https://docs.opencv.org/3.3.1/d4/d73/tutorial_py_contours_begin.html)            
-            if len(cnt) > 50:
-                # bounding rectangle of isopod contour
-                rx,ry,w,h = cv2.boundingRect(cnt)
-                
-# additional control mechanism - define minimal and maximal dimensions of bounding rectangle and approximate shape length (length of longer ellipse axis)
-                ellipse = cv2.fitEllipse(cnt)
-                center,axes,orientation = ellipse 
-                L = np.mean([math.sqrt(axes[1]*axes[0]*math.pi),max(axes)])
-                if L > det_len_val:
-                    idx += 1
-                    
-# get ROI from image
-                    roi=gray[max(0,ry-100):ry+h+100,max(0,rx-100):rx+w+100]                                     
-
-# =============================================================================
-# ii) work with ROI
-# =============================================================================
-                    
-                    ret, roi_thresh = cv2.threshold(roi,0,255,cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
-                    
-# adaptive kernel size and number of iterations of morphology-operations - this is a trick to deal with a broad size spectrum. bigger kernels and more iterations for large isopods, smaller kernels and fewer iterations. 
-# THIS WILL HAVE THE BIGGEST EFFECT ON THE RESULTS
-                    
-                    if L > 600:
-                        k3 = 3; niter3 = int(round(L * 0.005) -4)  * rec_kern_close_fac
-                        k4 = 9; niter4 = int(round(L * 0.007))   * rec_it_close_fac
-
-                    else:
-                        k3 = 3; niter3 = int(round(L * 0.015) - 4)  * rec_kern_open_fac
-                        k4 = 5; niter4 = int(round(L * 0.03) - 8) *  rec_it_open_fac
-                        
-                    kernel3 = cv2.getStructuringElement(cv2.MORPH_RECT,(k3,k3))
-                    morph3 = cv2.morphologyEx(roi_thresh,cv2.MORPH_CLOSE,kernel3, iterations = niter3)
-                    
-                    kernel4 = cv2.getStructuringElement(cv2.MORPH_CROSS,(k4,k4))
-                    morph4 = cv2.morphologyEx(morph3,cv2.MORPH_OPEN,kernel4, iterations = niter4)
-                    
-                    
-# create contour, centroid, and min. circle diameter (for length). the contour will be needed to create the mask (the "cookie-cutter"), the centroid will be used to draw a circle, then circle diameter is the length of our isopod                   
-                    ret1, contours1, hierarchy1 = cv2.findContours(copy.deepcopy(morph4),cv2.RETR_LIST ,cv2.CHAIN_APPROX_TC89_L1)       
-                    if contours1:
-                        areas = [cv2.contourArea(cnt1) for cnt1 in contours1]                
-                        shape = contours1[np.argmax(areas)]
-                        (cx,cy),radius = cv2.minEnclosingCircle(shape)
-                        
-# create the mask and create a masked array ("TRUE" pixels will be included, "FALSE" pixels excluded)
-                        mask = np.zeros_like(morph4) # Create mask where white is what we want, black otherwise
-                        mask = cv2.drawContours(mask, contours1, np.argmax(areas), 255, -1) # Draw filled contour in mask
-                        mask = cv2.erode(mask,np.ones((5,5),np.uint8),iterations = 1)
-                        masked =  ma.array(data=roi, mask = np.logical_not(mask))
-                    
-# calculate metrics for the pixels inside the mask
-                    M = cv2.moments(shape)
-                    a = int((M['m10']/M['m00'])+max(0,rx-100))
-                    b = int((M['m01']/M['m00'])+max(0,ry-100))
-                    c = (int(radius) * 2)/94.6876
-                    d = np.mean(masked) # mean grayscale value
-                    e = np.std(masked) # standard deviation of grayscale values
-                    f = np.min(masked) 
-                    g = np.max(masked)
-                    area = (cv2.contourArea(shape)/94.6876)/94.6876
-  
-# =============================================================================
-# iii) create control image and text files that contain the results
-# =============================================================================    
-    
-# write ROI info (centroid-coordinates and label) and metrics to file                           
-                    res_file = open(os.path.join(out_dir, i[0:len(i)-4] + '.txt'), 'a')
-                    res_file.write(str(idx) + '\t' + str(round(a,2)) + '\t' + str(round(b,2)) + "\t" + str(round(c,2)) + "\t" + str(round(area,2)) + "\t" +str(round(d,2)) + "\t" + str(round(e,2)) + "\t" + str(round(f,2)) + "\t" +  str(round(g,2))+ "\n")
-                    res_file.close()
-                    
-                    
-# draw bounding rectangle, contour and circle into original image to check if they are correct
-                    roi = cv2.cvtColor(roi, cv2.COLOR_GRAY2BGR)
-                    roi = cv2.circle(roi,(int(cx),int(cy)),int(radius),(255,0,0),3)
-                    roi = cv2.drawContours(roi, [shape], 0, (0,255,0), 3)   
-
-# draw ROI-box and label into original image
-                    img[max(0,ry-100):ry+h+100,max(0,rx-100):rx+w+100] = roi                    
-                    img = cv2.rectangle(img,(max(0,rx-100),max(0,ry-100)),(rx+w+100,ry+h+100),(0,0, 255),3)
-                    cv2.putText(img, str(idx),(a,b), cv2.FONT_HERSHEY_SIMPLEX, 2,(255,255,255),7,cv2.LINE_AA)
-
-# save control image                    
-        cv2.imwrite(os.path.join(out_dir , i[0:len(i)-4] + '_' + 'output.jpg'), img)   
-        print(i)
+# measurement engine: "roi" segments and measures every object in its own ROI, "labels" does this for all objects of a scan at once on label images. "labels" passes over the whole scan and is several times slower than "roi" on typical scans (see benchmarks/run.py --cases scanner scanner_labels) - keep "roi" unless you compare the two. with "labels", Area is counted in pixels and comes out slightly larger. the tiled mode below always uses "roi"
+engine = "roi"
 
 
+#%% procedure
 
+# (iii) PARALLEL PROCESSING
+# all images are processed in parallel, one image per worker process. the procedure for each image (i-ii, plus writing text file and control image) lives in iso_cv/scanner.py. 
+n_workers = None # number of worker processes (None = all cores, 1 = no parallel processing)
+
+# (iv) OUTPUT
+# each image gets its own text file in out_dir. optionally, the results of all images are collected in one table (.txt, .csv, .parquet, .feather or .sqlite) - all rows of an image that is processed again are replaced
+res_all = None # e.g. os.path.join(out_dir, "scanner.sqlite")
+
+# (v) CACHE
+# the gray image and the detection result (threshold and morphology of the whole scan) can be cached on disk - after changing only the recognition factors, detection is not recomputed
+cache_dir = None # e.g. os.path.join(out_dir, "cache"), None = no cache
+cache_size = 2 * 1024**3 # max. size of the cache in bytes (least recently used images are removed first)
+
+# (vi) LARGE SCANS
+# very large scans (e.g. A3 at 1200 dpi) can be processed in tiles of band rows - the scan is decoded once straight to gray (a third of the memory of the colour image) and then kept on disk, so apart from that short peak memory use depends on the band size instead of the scan size, and more workers fit into memory. results are the same, the control image is saved at 1/control_reduce of the scan size (1, 2, 4 or 8). the cache is not used in this mode
+band = None # e.g. 512, None = whole scan at once
+control_reduce = 4
+
+# (vii) CONTROL IMAGES
+# scan with boxes, outlines and labels, saved to out_dir in the background while the next scan is analysed. "full" = every scan, "thumbnail" = every scan at control_scale of its size, "sampled" = every control_every-th scan (per worker process) plus all flagged ones (any object outside control_flag), "off" = none
+control_mode = "full"
+control_every = 10
+control_scale = 0.25
+control_flag = None # e.g. Outlier("length", 1, 8) - length outside 1 - 8 mm (from iso_cv.control import Outlier)
+
+# (viii) PROFILING
+# time (wall and cpu) of every processing stage of every image, summarised in a run report. progress shows images/s and the remaining time
+profile = None # e.g. os.path.join(out_dir, "profile.json") or "profile.csv", None = off
+profile_memory = False # also record peak memory per stage (slower)
+progress = False
+
+params = dict(
+    det_len_val = det_len_val,
+    det_kern_close = det_kern_close,
+    det_it_close = det_it_close,
+    det_kern_open = det_kern_open,
+    det_it_open = det_it_open,
+    rec_kern_close_fac = rec_kern_close_fac,
+    rec_it_close_fac = rec_it_close_fac,
+    rec_kern_open_fac = rec_kern_open_fac,
+    rec_it_open_fac = rec_it_open_fac,
+    engine = engine,
+    )
+
+# the guard keeps worker processes (which re-import this file on windows) from starting the procedure themselves
+if __name__ == "__main__":
+    files = [os.path.join(in_dir, i) for i in os.listdir(in_dir) if os.path.isfile(os.path.join(in_dir, i))]
     
-
-                    
-
+    if res_all:
+        results = open_sink(res_all, ["Source_file"] + COLUMNS, key = ("Source_file", "PyLabel"))
+    profiler = Profiler()
+    bar = Progress(len(files)) if progress else None
+    control = ControlWriter(control_mode, every = control_every, flag = control_flag, scale = control_scale)
+    
+# a failing image does not stop the others - the error is printed and the next image is processed
+    for res in run_batch(process_scan, files, n_workers = n_workers, args = (out_dir, params, cache_dir, cache_size, band, control_reduce, control),
+                         profile = profile and ("memory" if profile_memory else True)):
+        profiler.add(res.profile)
+        if res.error:
+            print("FAILED: " + os.path.basename(res.item) + "\n" + res.error)
+        else:
+            if res_all:
+                results.replace_group(os.path.basename(res.item), [[os.path.basename(res.item)] + row for row in res.value])
+            if not bar:
+                print(os.path.basename(res.item))
+        if bar:
+            bar.update()
+    control.close()
+    if res_all:
+        results.close()
+    if profile:
+        profiler.save(profile)
+
+
+#%% parameter sweep (optional)
+# tries combinations of the parameters above against reference measurements (a results text file of one scan that has been checked by hand, named like the scan) and reports the fastest setting that is within tolerance. each scan is decoded about once per worker process
+
+run_sweep = False # set to True to run the sweep
+sweep_space = dict(det_len_val = [80, 100, 120], rec_it_open_fac = [0.5, 1, 1.5]) # parameters and values to try (all combinations)
+sweep_reference = None # required: table with hand-checked measurements, e.g. a corrected copy of the results file of one scan, named like the scan saved under a different name (the table written above would only score the current parameters against themselves)
+sweep_tolerance = 0.05 # max. mean relative error of length and area
+
+if __name__ == "__main__" and run_sweep:
+    if sweep_reference is None:
+        raise ValueError("set sweep_reference to a table with hand-checked measurements")
+    report, best = sweep("scanner", sweep_space, in_dir, sweep_reference, tolerance = sweep_tolerance, base_params = params, n_workers = n_workers)
+    for r in report:
+        print(r['config'], "time: %.2f s, length error: %.3f, area error: %.3f" % (r['seconds'], r['length_err'], r['area_err']))
+    print("fastest setting within tolerance:", best['config'] if best else None)
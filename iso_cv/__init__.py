@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+iso_cv - reusable building blocks behind the iso-cv-camera.py and
+iso-cv-scanner.py scripts
+"""
+
+from .batch import run_batch, BatchResult
+from .pipeline import CameraPipeline, ScannerPipeline
+from .control import ControlWriter, Outlier
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+# python -m iso_cv camera|scanner IN_DIR OUT_DIR - see cli.py
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
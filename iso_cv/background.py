@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+background estimation - gray level of the (bright) background of an image,
+taken as the median of its most common gray values, and correction of
+images to a common reference level.
+
+everything works on 256-bin histograms, so the cost of the estimate does
+not grow with the number of pixels beyond one histogram pass.
+"""
+
+import cv2
+import numpy as np
+
+from . import morphology
+
+
+def gray_histogram(img, mask=None):
+    # 256-bin histogram of an 8-bit image (only pixels where mask is non-zero)
+    return cv2.calcHist([img],[0],mask,[256],[0,256]).ravel()
+
+
+def mode_median(hist, n=9, ignore_zero=True):
+    """
+    median of the n most common gray values of a histogram. ties between
+    equally common values are resolved by the lower gray value. returns None
+    if the histogram is empty
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    if ignore_zero:
+        hist = hist.copy()
+        hist[0] = 0
+    present = np.flatnonzero(hist)
+    if not len(present):
+        return None
+    most_common = present[np.argsort(-hist[present], kind='stable')][:n]
+    return float(np.median(most_common))
+
+
+def background_pixels(img, thresh=245, kernel=(7,7), iterations=5):
+    """
+    image with everything but the background set to zero: pixels brighter
+    than thresh (reflections) are dropped, and the eroded remainder keeps
+    dark objects and their borders out of the estimate
+    """
+    ret,thresh_img = cv2.threshold(img,thresh,0,cv2.THRESH_TOZERO_INV)
+    return cv2.erode(thresh_img,morphology.ones(kernel),iterations = iterations)
+
+
+def estimate_background(img, mask=None, n=9, **kwargs):
+    """
+    background gray level of an image: median of the n most common gray
+    values among the background pixels (see background_pixels, which takes
+    the keyword arguments). an optional mask restricts the estimate to a
+    part of the image
+    """
+    return mode_median(gray_histogram(background_pixels(img, **kwargs), mask), n)
+
+
+def estimate_background_regions(img, grid=(4,4), mask=None, n=9, **kwargs):
+    """
+    background level per region: the image is split into grid (rows, cols)
+    regions and the level is estimated for each. returns a float array of
+    shape grid, with nan for regions without background pixels
+    """
+    bg = background_pixels(img, **kwargs)
+    rows = np.linspace(0, img.shape[0], grid[0] + 1).astype(int)
+    cols = np.linspace(0, img.shape[1], grid[1] + 1).astype(int)
+    levels = np.full(grid, np.nan)
+    for r in range(grid[0]):
+        for c in range(grid[1]):
+            sub_mask = None if mask is None else mask[rows[r]:rows[r+1], cols[c]:cols[c+1]]
+            level = mode_median(gray_histogram(bg[rows[r]:rows[r+1], cols[c]:cols[c+1]], sub_mask), n)
+            if level is not None:
+                levels[r, c] = level
+    return levels
+
+
+def correct_background(img, level, ref=240):
+    """
+    shift all gray values by (ref - level), saturating at 0 and 255 - the
+    image stays uint8 throughout (done with a lookup table)
+    """
+    shift = int(round(ref - level))
+    lut = np.clip(np.arange(256) + shift, 0, 255).astype(np.uint8)
+    return cv2.LUT(img, lut)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+batch engine - spreads independent work items (images, ROIs) over a pool of
+worker processes and hands the results back in input order
+"""
+
+import os
+import threading
+import traceback
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from . import profiling
+
+# one result per work item. "error" holds the formatted traceback if the
+# item failed, in which case "value" is None. "profile" holds the stage
+# records of the item if the batch is profiled
+BatchResult = namedtuple("BatchResult", ["item", "value", "error", "profile"], defaults=(None,))
+
+# item of the results of the finalizer (see run_batch)
+FINAL = "<final>"
+
+
+def resolve_workers(n_workers=None):
+    """
+    number of worker processes to use: None or 0 = all cores, negative values
+    leave that many cores free (e.g. -1 = all but one)
+    """
+    n_cpu = os.cpu_count() or 1
+    if not n_workers:
+        return n_cpu
+    if n_workers < 0:
+        return max(1, n_cpu + n_workers)
+    return n_workers
+
+
+def _label(item):
+    # name of an item in the profile records
+    return os.path.basename(item) if isinstance(item, str) else str(item)
+
+
+def _call(func, item, args, kwargs, profile=False):
+    # failures are caught inside the worker so that one broken image does
+    # not take down the whole batch
+    profiler = profiling.Profiler(memory = profile == "memory") if profile else None
+    try:
+        if profiler:
+            with profiling.activate(profiler), profiler.image(_label(item)):
+                value = func(item, *args, **kwargs)
+        else:
+            value = func(item, *args, **kwargs)
+        return BatchResult(item, value, None, profiler and profiler.records)
+    except Exception:
+        return BatchResult(item, None, traceback.format_exc(), profiler and profiler.records)
+
+
+def _collect(item, future):
+    # errors outside of func (e.g. results that can't be pickled, or a worker
+    # that died) are reported for the item as well
+    try:
+        return future.result()
+    except Exception:
+        return BatchResult(item, None, traceback.format_exc())
+
+
+_barrier = None
+
+def _init(barrier, initializer, initargs):
+    # worker initializer of a batch with a finalizer
+    global _barrier
+    _barrier = barrier
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _finish(item, finalizer, timeout):
+    # every worker waits here until all of them have taken a call, so each
+    # one takes exactly one
+    try:
+        _barrier.wait(timeout)
+    except threading.BrokenBarrierError:
+        pass
+    return finalizer()
+
+
+def run_batch(func, items, n_workers=None, args=(), kwargs=None,
+              initializer=None, initargs=(), max_pending=None, profile=False, finalizer=None):
+    """
+    call func(item, *args, **kwargs) for every item and yield BatchResults in
+    the order of items. func (and initializer) must be importable top-level
+    functions so they can be sent to the worker processes.
+
+    n_workers = 1 runs everything in the calling process (useful for
+    debugging). max_pending limits how many items are in flight at once
+    (default: 4 per worker), so huge directories don't queue up in memory.
+
+    with profile = True (or "memory" to include peak memory), the stages of
+    every item are recorded (see profiling.py) and returned in
+    BatchResult.profile
+
+    finalizer (also an importable top-level function) is called without
+    arguments once in every worker process after the last item, e.g. to
+    wait for work the worker does in the background. its return values are
+    yielded last, one BatchResult per worker with item FINAL
+    """
+    kwargs = kwargs or {}
+    n_workers = resolve_workers(n_workers)
+
+    if n_workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield _call(func, item, args, kwargs, profile)
+        if finalizer is not None:
+            yield _call(lambda item: finalizer(), FINAL, (), {})
+        return
+
+    max_pending = max_pending or 4 * n_workers
+    pending = deque()
+    if finalizer is not None:
+        barrier = multiprocessing.Barrier(n_workers)
+        initializer, initargs = _init, (barrier, initializer, initargs)
+    with ProcessPoolExecutor(n_workers, initializer=initializer,
+                             initargs=initargs) as pool:
+        try:
+            for item in items:
+                future = pool.submit(_call, func, item, args, kwargs, profile)
+                pending.append((item, future))
+                if len(pending) >= max_pending:
+                    yield _collect(*pending.popleft())
+            while pending:
+                yield _collect(*pending.popleft())
+            if finalizer is not None:
+                # all workers are idle now - the barrier in _finish (with a
+                # timeout, in case one is gone) hands one call to each
+                for i in range(n_workers):
+                    pending.append((FINAL, pool.submit(_call, _finish, FINAL, (finalizer, 60), {})))
+                while pending:
+                    yield _collect(*pending.popleft())._replace(item = FINAL)
+        finally:
+            for item, future in pending:
+                future.cancel()
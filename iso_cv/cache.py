@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+disk cache for intermediate images (decoded gray image, threshold and
+morphology results, ROI crops).
+
+every stage is keyed by a hash of its name, its parameters and the key(s) of
+the stage(s) it depends on - the first stage depends on the path, size and
+modification time of the input file (not on its content, so a cache hit
+needs no read of the input at all). changing a parameter therefore only
+invalidates the stage that uses it and everything downstream. arrays are
+stored as .npy files and returned memory-mapped (copy-on-write, changes are
+never written back).
+
+the cache is limited in size, the least recently used files are removed
+first. several processes can share a cache directory: each one checks the
+size of the whole directory every few files it writes, so the limit holds
+for all of them together (give or take the files written between two
+checks). files another process removes in the meantime are skipped.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+
+def make_key(*parts):
+    # stable hash of stage name, parameters and upstream keys
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+class NullCache(object):
+    """
+    stand-in when no cache is used - every stage is simply computed
+    """
+
+    def input_key(self, path):
+        return None
+
+    def stage(self, name, deps, func, *args):
+        return None, func(*args)
+
+
+NULL_CACHE = NullCache()
+
+
+class StageCache(object):
+    """
+    disk-backed stage cache in directory root, holding at most max_bytes
+    (default 2 GB). the size on disk is checked every check_every files
+    written by this process, and whenever the files written since the
+    last check alone would go over max_bytes
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024**3, check_every=8):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self._puts = 0
+        self._size = sum(size for p, mtime, size in self._files())
+
+    def _files(self):
+        # (path, mtime, size) of every cached file
+        for dirpath, dirs, files in os.walk(self.root):
+            for f in files:
+                if f.endswith('.npy'):
+                    p = os.path.join(dirpath, f)
+                    try:
+                        st = os.stat(p)
+                    except OSError: # removed by another process
+                        continue
+                    yield p, st.st_mtime, st.st_size
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def input_key(self, path):
+        # key of an input file - changes when the file is replaced or modified
+        st = os.stat(path)
+        return make_key('input', os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            arr = np.load(path, mmap_mode='c')
+        except (IOError, OSError, ValueError):
+            return None
+        # the modification time doubles as "last used" for the eviction
+        try:
+            os.utime(path, None)
+        except OSError: # removed by another process - the mapping stays valid
+            pass
+        return arr
+
+    def put(self, key, arr):
+        path = self._path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(arr))
+            n = f.tell()
+        os.replace(tmp, path)
+        self._size += n
+        self._puts += 1
+        if self._size > self.max_bytes or self._puts >= self.check_every:
+            self.check()
+
+    def check(self):
+        """
+        read the size of the cache from disk (the files of all processes
+        sharing it) and evict if it is over max_bytes
+        """
+        self._puts = 0
+        files = list(self._files())
+        self._size = sum(size for p, mtime, size in files)
+        if self._size > self.max_bytes:
+            self.evict(files = files)
+
+    def stage(self, name, deps, func, *args):
+        """
+        result of func(*args), taken from the cache if a stage with the same
+        name and deps (parameters and upstream keys) was computed before.
+        returns (key, array) - the key is passed on as dependency of the
+        stages downstream
+        """
+        key = make_key(name, deps)
+        arr = self.get(key)
+        if arr is None:
+            arr = func(*args)
+            self.put(key, arr)
+        return key, arr
+
+    def evict(self, target=0.9, files=None):
+        # remove least recently used files until the cache is below target * max_bytes.
+        # the size is read from disk, since several processes may share the cache
+        files = sorted(self._files() if files is None else files, key=lambda f: f[1])
+        size = sum(f[2] for f in files)
+        for p, mtime, n in files:
+            if size <= target * self.max_bytes:
+                break
+            try:
+                os.remove(p)
+            except OSError: # removed by another process
+                pass
+            size -= n
+        self._size = size
+
+    def clear(self):
+        for p, mtime, size in list(self._files()):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+        self._size = 0
+
+
+_open_caches = {}
+
+def open_cache(root, max_bytes=2 * 1024**3):
+    """
+    StageCache for root, shared by all calls within one (worker) process.
+    root = None gives the null cache
+    """
+    if root is None:
+        return NULL_CACHE
+    if root not in _open_caches:
+        _open_caches[root] = StageCache(root, max_bytes)
+    return _open_caches[root]
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+camera procedure - the per-image steps of iso-cv-camera.py as functions that
+can be handed to a worker pool (see batch.py)
+"""
+
+import os
+import cv2
+import numpy as np
+
+from .background import estimate_background, correct_background
+from .cache import NULL_CACHE
+from . import morphology, profiling
+from .control import resized
+from .measure import masked_stats
+from .metadata import read_header, file_date
+
+
+# =============================================================================
+# adjust grayscale
+# =============================================================================
+
+def get_picture_date(data):
+    # capture date (exif tag 306) from the raw bytes of an image, as YYYYMMDD,
+    # or None if there is none - only the header is parsed (see metadata.py)
+    return read_header(data)['date']
+
+
+def gray_name(path, date):
+    # name of the histogram adjusted image
+    label = os.path.splitext(os.path.basename(path))[0]
+    return label + "_" + date + "_gray" + ".jpg"
+
+
+def normalize_gray(img, ref=240):
+    """
+    shift the gray values of an image so that its background (median of the
+    9 most common gray values, see background.py) matches ref
+    """
+    med = estimate_background(img)
+    if med is None:
+        raise ValueError("no background pixels found")
+    return correct_background(img, med, ref)
+
+
+def normalize_data(data, path, ref=240, resize=0.5):
+    """
+    adjust the grayscale of one camera image from its raw bytes (the date
+    comes from the same bytes that are decoded - images without exif date
+    are named by the modification date of the file). returns the name of
+    the gray image (see gray_name) and the image
+    """
+    with profiling.stage("exif"):
+        new_img_name = gray_name(path, get_picture_date(data) or file_date(path))
+
+    with profiling.stage("decode"):
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise IOError("could not decode image: " + path)
+
+# reduce resolution - important if you have a lot of images
+    if resize != 1:
+        with profiling.stage("resize"):
+            img = cv2.resize(img, (0,0), fx=resize, fy=resize)
+
+    with profiling.stage("background"):
+        img = normalize_gray(img, ref)
+    return new_img_name, img
+
+
+def normalize_file(path, gray_dir, ref=240, resize=0.5):
+    """
+    read one camera image, adjust its grayscale and save it to gray_dir.
+    the file is read only once. returns the name of the saved image
+    """
+    with profiling.stage("read"):
+        with open(path, 'rb') as f:
+            data = f.read()
+    new_img_name, img = normalize_data(data, path, ref, resize)
+    with profiling.stage("write"):
+        cv2.imwrite(os.path.join(gray_dir, new_img_name), img)
+    return new_img_name
+
+
+# =============================================================================
+# phenotyping
+# =============================================================================
+
+# default detection and phenotyping parameters - see iso-cv-camera.py for
+# what they do
+DEFAULTS = dict(
+    roi_area = 400,
+    det_scale = 1, # locate the isopod on an image downsampled by this factor
+    det_val = 799,
+    det_it = 3,
+    det_kern_close = (5,5),
+    det_it_close = 3,
+    det_kern_open = (7,7),
+    det_it_open = 5,
+    rec_val = 499,
+    rec_it = 3,
+    rec_kern_close = (3,3),
+    rec_it_close = 3,
+    rec_kern_open = (9,9),
+    rec_it_open = 6,
+    scale = 70, # pixels per mm
+    )
+
+# columns of the results table
+COLUMNS = ["Source_file", "Length", "Area", "Mean", "StdDev", "Scale"]
+
+
+def get_params(params=None):
+    p = dict(DEFAULTS)
+    p.update(params or {})
+    return p
+
+
+def read_gray(path, cache=None):
+    """
+    read a (histogram adjusted) gray image. returns (key, img) - the key
+    identifies the image in the stage cache (None without cache)
+    """
+    cache = cache or NULL_CACHE
+    with profiling.stage("decode"):
+        return cache.stage('gray', (cache.input_key(path),), _imread_gray, path)
+
+
+def _imread_gray(path):
+    img = cv2.imread(path, 0)
+    if img is None:
+        raise IOError("could not read image: " + path)
+    return img
+
+
+def largest_contour(img):
+    contours, hierarchy = cv2.findContours(img.copy(),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_TC89_L1)[-2:]
+    if not contours:
+        return None
+    areas = [cv2.contourArea(c) for c in contours]
+    return contours[int(np.argmax(areas))]
+
+
+# i) find ROI in image
+
+def _scale_kernel(ksize, iterations, s):
+    """
+    kernel and iterations of a rectangular morphology operation on an image
+    downsampled by s: the reach of the iterated kernel (half size times
+    iterations) is scaled, and applied in a single iteration
+    """
+    return tuple(2 * int(round((k // 2) * iterations * s)) + 1 for k in ksize), 1
+
+
+def scaled_params(params, s):
+    """
+    detection parameters for an image downsampled by s - the block size of
+    the adaptive threshold and the reach of the morphology operations shrink
+    with the image
+    """
+    p = dict(params)
+    p['det_val'] = max(3, int(round(params['det_val'] * s)) | 1)
+    p['det_kern_close'], p['det_it_close'] = _scale_kernel(params['det_kern_close'], params['det_it_close'], s)
+    p['det_kern_open'], p['det_it_open'] = _scale_kernel(params['det_kern_open'], params['det_it_open'], s)
+    return p
+
+
+def _downsample(img, s):
+    return cv2.resize(img, (0,0), fx=s, fy=s, interpolation=cv2.INTER_AREA)
+
+
+def _background_mask(img, s=1):
+    # area of the image that is not blown out (> 245), with a wide margin removed
+    thresh_img = cv2.inRange(img, 1, 245)
+    if s == 1:
+        dilation = cv2.dilate(thresh_img,morphology.ones((9,9)),iterations = 3)
+        return cv2.erode(dilation,morphology.ones((51,51)),iterations = 10)
+    kd, it = _scale_kernel((9,9), 3, s)
+    ke, it = _scale_kernel((51,51), 10, s)
+    dilation = cv2.dilate(thresh_img,morphology.ones(kd))
+    return cv2.erode(dilation,morphology.ones(ke))
+
+
+def _detect(img, erosion, p):
+    morph = cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY_INV,p['det_val'],p['det_it'])
+    morph = cv2.bitwise_and(morph, morph, mask = erosion)
+    return cv2.morphologyEx(morph,cv2.MORPH_CLOSE,morphology.ones((p['det_kern_close'])), iterations = p['det_it_close'])
+
+
+def _open(morph, p):
+    return cv2.morphologyEx(morph,cv2.MORPH_OPEN,morphology.ones((p['det_kern_open'])), iterations = p['det_it_open'])
+
+
+def _crop(img, morph, morph1, q, s=1):
+    # ROI around the largest object (after opening, or before if opening
+    # removed everything). the detection images may be downsampled by s
+    largest = largest_contour(morph1)
+    if largest is None:
+        largest = largest_contour(morph)
+    if largest is None:
+        raise ValueError("no object found")
+    (x,y),radius = cv2.minEnclosingCircle(largest)
+    x = int(x / s)
+    y = int(y / s)
+    return img[max(0,y-q):y+q,max(0,x-q):x+q]
+
+
+def find_roi(img, params, cache=None, key=None):
+    """
+    locate the isopod and cut out a square ROI (2 * roi_area pixels wide)
+    around it. with det_scale < 1 the isopod is located on a downsampled
+    image (with scaled parameters, see scaled_params), and only the ROI is
+    taken from the full resolution image.
+
+    with a cache, every intermediate (downsampled image, threshold mask,
+    detection, opening, ROI) is stored, keyed by the parameters it depends
+    on. returns (key, roi)
+    """
+    cache = cache or NULL_CACHE
+    s = params['det_scale']
+    if s == 1:
+        p, small_key, small = params, key, img
+    else:
+        p = scaled_params(params, s)
+        with profiling.stage("downsample"):
+            small_key, small = cache.stage('small', (key, s), _downsample, img, s)
+    with profiling.stage("background_mask"):
+        mask_key, erosion = cache.stage('erosion', (small_key, s), _background_mask, small, s)
+    det = (p['det_val'], p['det_it'], p['det_kern_close'], p['det_it_close'])
+    with profiling.stage("detection"):
+        morph_key, morph = cache.stage('morph', (small_key, mask_key, det), _detect, small, erosion, p)
+    with profiling.stage("opening"):
+        morph1_key, morph1 = cache.stage('morph1', (morph_key, p['det_kern_open'], p['det_it_open']), _open, morph, p)
+    with profiling.stage("contours"):
+        return cache.stage('roi', (key, morph_key, morph1_key, p['roi_area'], s), _crop, img, morph, morph1, p['roi_area'], s)
+
+
+# ii) work with ROI
+
+def analyse_roi(roi, params):
+    """
+    segment the isopod inside the ROI and measure it. returns a dict with
+    the contour, enclosing circle and metrics, or None if nothing was found
+    """
+    p = params
+    with profiling.stage("roi_threshold"):
+        morph2 = cv2.adaptiveThreshold(roi,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY_INV,p['rec_val'],p['rec_it'])
+    with profiling.stage("roi_morphology"):
+        morph2 = cv2.morphologyEx(morph2,cv2.MORPH_CLOSE,morphology.ones((p['rec_kern_close'])), iterations = p['rec_it_close'])
+        morph2 = cv2.morphologyEx(morph2,cv2.MORPH_OPEN,morphology.structuring_element(cv2.MORPH_CROSS,p['rec_kern_open']), iterations = p['rec_it_open'])
+    with profiling.stage("roi_contours"):
+        largest2 = largest_contour(morph2)
+    if largest2 is None:
+        return None
+
+# create mask and do algebra on area
+    scale = p['scale']
+    (x,y),radius = cv2.minEnclosingCircle(largest2)
+    radius = int(radius)
+
+# gray value metrics of the pixels inside the mask (None if the eroded mask is empty - the results sinks write it as a missing value)
+    with profiling.stage("roi_stats"):
+        mask = np.zeros_like(roi)
+        mask = cv2.drawContours(mask, [largest2], 0, 255, -1)
+        mask = cv2.erode(mask,morphology.ones((5,5)),iterations = 1)
+        stats = masked_stats(roi, mask)
+    return dict(
+        contour = largest2,
+        circle = ((x,y), radius),
+        length = round((radius * 2)/scale,2),
+        area = round((cv2.contourArea(largest2)/scale)/scale,2),
+        mean = int(stats[0]) if stats else None,
+        sd = round(stats[1],2) if stats else None,
+        )
+
+
+def analyse_gray(img, params=None, first=True, cache=None, key=None):
+    """
+    full phenotyping procedure for one gray image. on the first run the ROI
+    is searched in the image, otherwise (redo-chunks) the image is the ROI.
+    returns (roi, record) - record is None if no isopod was found in the ROI
+    """
+    params = get_params(params)
+    if first:
+        roi_key, roi = find_roi(img, params, cache, key)
+    else:
+        roi = img
+    return roi, analyse_roi(roi, params)
+
+
+def result_row(name, rec, params):
+    # one row of the results table (see COLUMNS)
+    return [name, rec['length'], rec['area'], rec['mean'], rec['sd'], params['scale']]
+
+
+def draw_control(roi, rec):
+    # enclosing circle and contour drawn into the ROI, to check the segmentation
+    (x,y),radius = rec['circle']
+    roi = cv2.cvtColor(roi, cv2.COLOR_GRAY2BGR)
+    roi = cv2.circle(roi,(int(x),int(y)), radius,(255,0,0),2)
+    return cv2.drawContours(roi, [rec['contour']], 0, (0,0,255), 2)
+
+
+def control_image(roi, rec, scale=1):
+    """
+    control image of one image at scale times the size of the ROI (see
+    control.py): the plain ROI if no isopod was found
+    """
+    if rec:
+        roi = draw_control(roi, rec)
+    return resized(roi, scale)
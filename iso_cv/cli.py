@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+command line entry point - runs the camera or scanner pipeline (see
+pipeline.py) over all images of a directory:
+
+    python -m iso_cv camera IN_DIR OUT_DIR [--set scale=70 det_val=599]
+    python -m iso_cv scanner IN_DIR OUT_DIR [--workers 4] [--results res.csv]
+
+results go to OUT_DIR/<procedure>.txt (or --results, any format of
+results.open_sink), control images to OUT_DIR. parameters not given keep
+the defaults of camera.py / scanner.py
+"""
+
+import os
+import sys
+import ast
+import argparse
+
+from . import camera, scanner
+from .control import MODES, ControlWriter
+from .metadata import IMAGE_EXTENSIONS
+from .pipeline import CameraPipeline, ScannerPipeline
+from .results import open_sink
+
+
+def parse_params(items, defaults):
+    """
+    NAME=VALUE strings as a parameter dict. values are python literals
+    (e.g. det_kern_close=(5,5)), anything else is taken as a string
+    """
+    params = {}
+    for item in items:
+        name, sep, value = item.partition('=')
+        if not sep or name not in defaults:
+            raise ValueError("unknown parameter: " + item)
+        try:
+            params[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            params[name] = value
+    return params
+
+
+def image_files(directory):
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                  if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m iso_cv", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="procedure")
+    sub.required = True
+    for name in ("camera", "scanner"):
+        p = sub.add_parser(name, help="%s pipeline" % name)
+        p.add_argument("in_dir", help="directory with the images")
+        p.add_argument("out_dir", help="directory for results and control images")
+        p.add_argument("--set", nargs="+", default=[], metavar="NAME=VALUE", help="parameters (see %s.py)" % name)
+        p.add_argument("--results", help="results file (default: OUT_DIR/%s.txt)" % name)
+        p.add_argument("--workers", type=int, default=1, help="worker processes (0 = all cores)")
+        p.add_argument("--control", choices=MODES, default="full", help="which control images to write (see control.py)")
+        p.add_argument("--every", type=int, default=10, help="with --control sampled: every Nth image")
+        p.add_argument("--scale", type=float, default=0.25, help="with --control thumbnail: size of the thumbnails")
+        if name == "camera":
+            p.add_argument("--ref", type=int, default=240, help="reference gray value of the background")
+            p.add_argument("--resize", type=float, default=0.5, help="resize factor of the raw images")
+            p.add_argument("--no-normalize", action="store_true", help="images are already normalized gray images")
+    args = parser.parse_args(argv)
+
+    module = camera if args.procedure == "camera" else scanner
+    try:
+        params = parse_params(args.set, module.DEFAULTS)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.procedure == "camera":
+        pipe = CameraPipeline(params, ref = args.ref, resize = args.resize, normalize = not args.no_normalize)
+        columns, key = pipe.columns, "Source_file"
+    else:
+        pipe = ScannerPipeline(params)
+        columns, key = ["Source_file"] + pipe.columns, ("Source_file", "PyLabel")
+
+    os.makedirs(args.out_dir, exist_ok = True)
+    res_path = args.results or os.path.join(args.out_dir, args.procedure + ".txt")
+    control = ControlWriter(args.control, every = args.every, scale = args.scale)
+    paths = image_files(args.in_dir)
+
+    failed = 0
+    with open_sink(res_path, columns, key = key) as sink, control:
+        for res in pipe.process_many(paths, n_workers = args.workers or None, control_dir = args.out_dir, control = control):
+            name = os.path.basename(res.item)
+            if res.error:
+                failed += 1
+                print(name + ": failed\n" + res.error, file=sys.stderr)
+            elif args.procedure == "camera":
+                if res.value is not None:
+                    sink.write(pipe.row(name, res.value))
+                print(name + ("" if res.value is not None else ": no isopod found"))
+            else:
+                sink.replace_group(name, [[name] + row for row in pipe.rows(res.value)])
+                print("%s: %d objects" % (name, len(res.value)))
+    print("%d images, %d failed - results in %s" % (len(paths), failed, res_path))
+    return 1 if failed or control.errors else 0
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+control images - the annotated images written next to the results to check
+the segmentation. drawing, encoding and writing them is a large part of the
+time per image, so ControlWriter does it on background threads (while the
+next image is analysed), and can write fewer or smaller images:
+
+- "full": every image at full size (as before)
+- "thumbnail": every image, at scale times its size
+- "sampled": every Nth image, plus all flagged ones (e.g. no isopod found,
+  or measurements outside a plausible range - see Outlier)
+- "off": none
+
+the images handed to a writer must not be changed afterwards - they are
+drawn on later.
+"""
+
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import cv2
+
+MODES = ("off", "sampled", "thumbnail", "full")
+
+
+class Outlier(object):
+    """
+    flag for sampled control images: a record (dict, camera) or any of a
+    list of records (scanner) with a value of field outside low..high
+    """
+
+    def __init__(self, field, low=None, high=None):
+        self.field, self.low, self.high = field, low, high
+
+    def __call__(self, result):
+        records = result if isinstance(result, list) else [result]
+        for rec in records:
+            value = rec[self.field]
+            if (self.low is not None and value < self.low) or (self.high is not None and value > self.high):
+                return True
+        return False
+
+    def __repr__(self):
+        return "Outlier(%r, %r, %r)" % (self.field, self.low, self.high)
+
+
+class ControlWriter(object):
+    """
+    writes control images in mode (see MODES) on n_threads background
+    threads - n_threads = 0 writes them right away, in the calling thread.
+    at most max_pending images (default: 2 per thread) wait to be written,
+    submit blocks when there are more. every: with "sampled", every Nth
+    image is written. flag: with "sampled", images whose result it returns
+    True for are written as well (e.g. Outlier("length", 1, 8)). scale:
+    size of the thumbnails. quality: jpeg quality (default: opencv's)
+
+    failed writes are printed and kept in errors. call close (or use as a
+    context manager) to wait for the pending images. in worker processes
+    (see batch.py), a writer is rebuilt once per process and shared by all
+    of its images - sampling then counts the images of each worker, and
+    pending images are finished when the worker exits
+    """
+
+    def __init__(self, mode="full", every=10, flag=None, scale=0.25, quality=None, n_threads=2, max_pending=None):
+        if mode not in MODES:
+            raise ValueError("unknown control image mode: %r (one of %s)" % (mode, ", ".join(MODES)))
+        self._settings = dict(mode = mode, every = every, flag = flag, scale = scale, quality = quality,
+                              n_threads = n_threads, max_pending = max_pending)
+        self.mode, self.every, self.flag, self.quality = mode, max(1, every), flag, quality
+        self.scale = scale if mode == "thumbnail" else 1
+        self.n_threads = n_threads
+        self.count = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * max(1, n_threads))
+        self._pending = set()
+        self._pool = None
+
+    def __reduce__(self):
+        return _process_writer, (self._settings,)
+
+    def flagged(self, result):
+        # True if the flag marks result
+        return bool(self.flag and result is not None and self.flag(result))
+
+    def wanted(self, flagged=False):
+        """
+        whether the next image gets a control image - counts the images, so
+        call it once per image
+        """
+        with self._lock:
+            self.count += 1
+            count = self.count
+        if self.mode == "off":
+            return False
+        if self.mode == "sampled":
+            return flagged or (count - 1) % self.every == 0
+        return True
+
+    def submit(self, path, draw, *args, flagged=False):
+        """
+        write draw(*args, scale = s) to path, if the mode wants this image.
+        draw returns the control image at s times the size of the image (s
+        is 1 unless mode is "thumbnail"). returns True if the image is
+        written
+        """
+        if not self.wanted(flagged):
+            return False
+        if not self.n_threads:
+            self._write(path, draw, args)
+            return True
+        self._slots.acquire()
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.n_threads, thread_name_prefix = "control")
+            future = self._pool.submit(self._background, path, draw, args)
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return True
+
+    def _write(self, path, draw, args):
+        img = draw(*args, scale = self.scale)
+        options = [cv2.IMWRITE_JPEG_QUALITY, self.quality] if self.quality else []
+        if not cv2.imwrite(path, img, options):
+            raise IOError("could not write control image: " + path)
+
+    def _background(self, path, draw, args):
+        # nobody waits for the result, so failures are reported here
+        try:
+            self._write(path, draw, args)
+        except Exception:
+            error = traceback.format_exc()
+            self.errors.append((path, error))
+            print("FAILED control image: " + os.path.basename(path) + "\n" + error, file=sys.stderr)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    def take_errors(self):
+        # the errors so far, removed from errors - a write that fails
+        # meanwhile is kept for the next call
+        n = len(self.errors)
+        errors = self.errors[:n]
+        del self.errors[:n]
+        return errors
+
+    def flush(self):
+        # wait until all submitted images are written
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+
+    def close(self):
+        self.flush()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# one writer per worker process and settings (see ControlWriter.__reduce__)
+_writers = {}
+
+def _process_writer(settings):
+    key = repr(sorted(settings.items()))
+    if key not in _writers:
+        _writers[key] = ControlWriter(**settings)
+    return _writers[key]
+
+
+def finish_process_writers():
+    """
+    wait for the pending images of the writers of this (worker) process and
+    return their errors not taken yet
+    """
+    errors = []
+    for writer in _writers.values():
+        writer.flush()
+        errors.extend(writer.take_errors())
+    return errors
+
+
+def open_control(control=None):
+    # writer for the control argument of the processing functions - None
+    # writes full size images right away, in the calling thread
+    return control if control is not None else ControlWriter("full", n_threads = 0)
+
+
+def resized(img, scale):
+    # img at scale times its size (no copy for scale 1)
+    if scale == 1:
+        return img
+    return cv2.resize(img, (0,0), fx = scale, fy = scale, interpolation = cv2.INTER_AREA)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+manifest of finished inputs - lets a pipeline stage skip work it has already
+done, independent of how the outputs are named, and resume a run that was
+interrupted
+"""
+
+import os
+import json
+import hashlib
+
+
+def file_hash(path, chunk_size=1 << 20):
+    # sha1 of the file content
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest(object):
+    """
+    json file with one entry per finished input, keyed by the content hash
+    plus mtime of the input file. inputs whose size and mtime are unchanged
+    since they were recorded are recognised without hashing them again.
+
+    entries are written to disk every save_every calls of mark_done (and on
+    save), so a crashed run loses at most that many entries. with
+    output_dir, an input only counts as done while its recorded output
+    (a file name in output_dir) still exists - deleted outputs are made
+    again.
+    """
+
+    def __init__(self, path, save_every=20, output_dir=None):
+        self.path = path
+        self.save_every = save_every
+        self.output_dir = output_dir
+        self.entries = {}
+        self._paths = {}
+        self._unsaved = 0
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f).get('entries', {})
+            for key, entry in self.entries.items():
+                self._paths[entry['path']] = (entry['size'], entry['mtime_ns'], key)
+
+    def key(self, path):
+        st = os.stat(path)
+        known = self._paths.get(os.path.abspath(path))
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        return file_hash(path) + '-' + str(st.st_mtime_ns)
+
+    def is_done(self, path, key=None):
+        entry = self.entries.get(key or self.key(path))
+        if entry is None:
+            return False
+        if self.output_dir is None or entry['output'] is None:
+            return True
+        return os.path.isfile(os.path.join(self.output_dir, entry['output']))
+
+    def get(self, path, key=None):
+        # entry of a finished input (contains the "output"), or None
+        return self.entries.get(key or self.key(path))
+
+    def mark_done(self, path, output=None, key=None):
+        key = key or self.key(path)
+        st = os.stat(path)
+        path = os.path.abspath(path)
+        self.entries[key] = dict(path = path, size = st.st_size,
+                                 mtime_ns = st.st_mtime_ns, output = output)
+        self._paths[path] = (st.st_size, st.st_mtime_ns, key)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        # write to a temporary file first, so an interrupted save never
+        # leaves a broken manifest behind
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(version = 1, entries = self.entries), f)
+        os.replace(tmp, self.path)
+        self._unsaved = 0
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+intensity statistics of segmented objects - mean, standard deviation,
+minimum and maximum gray value, computed from gray value histograms.
+
+one histogram pass over the pixels yields all four values, without building
+masked array copies. label_stats does this for all objects of a label image
+at once.
+"""
+
+import cv2
+import numpy as np
+
+
+def hist_stats(hist):
+    """
+    count, mean, sd, min and max from 256-bin histogram(s) - hist can be a
+    single histogram or an array with one histogram per row. sd is the
+    population standard deviation (like np.std). empty histograms give
+    count 0 and nan for the other values
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    values = np.arange(hist.shape[-1], dtype=np.float64)
+    count = hist.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (hist * values).sum(axis=-1) / count
+        var = (hist * values**2).sum(axis=-1) / count - mean**2
+    sd = np.sqrt(np.maximum(var, 0))
+
+    present = hist > 0
+    empty = ~present.any(axis=-1)
+    vmin = np.where(empty, np.nan, np.argmax(present, axis=-1))
+    vmax = np.where(empty, np.nan, hist.shape[-1] - 1 - np.argmax(present[..., ::-1], axis=-1))
+    return dict(count = count, mean = mean, sd = sd, min = vmin, max = vmax)
+
+
+def masked_stats(img, mask):
+    """
+    (mean, sd, min, max) of the pixels of an 8-bit image where mask is
+    non-zero, or None if the mask is empty
+    """
+    stats = hist_stats(cv2.calcHist([img],[0],mask,[256],[0,256]).ravel())
+    if stats['count'] == 0:
+        return None
+    return (float(stats['mean']), float(stats['sd']), int(stats['min']), int(stats['max']))
+
+
+def label_histograms(img, labels, n_labels=None):
+    """
+    256-bin gray value histogram of every label of a label image, in one
+    pass - an array with one row per label. label 0 (background) is left
+    empty
+    """
+    if n_labels is None:
+        n_labels = int(labels.max()) + 1
+    fg = labels > 0
+    idx = labels[fg].astype(np.int64) * 256 + img[fg]
+    return np.bincount(idx, minlength=n_labels * 256).reshape(n_labels, 256)
+
+
+def label_stats(img, labels, n_labels=None):
+    """
+    statistics of all objects of a label image (e.g. from
+    cv2.connectedComponents) in one pass: returns a dict of arrays (see
+    hist_stats) indexed by label. label 0 is treated as background and left
+    empty
+    """
+    return hist_stats(label_histograms(img, labels, n_labels))
+
+
+def otsu_thresholds(hist):
+    """
+    Otsu's threshold of every row of an array of 256-bin histograms, all at
+    once. empty histograms (and those with a single gray value) give 0, like
+    cv2.threshold
+    """
+    hist = np.atleast_2d(np.asarray(hist, dtype=np.float64))
+    total = hist.sum(axis=-1, keepdims=True)
+    p = hist / np.maximum(total, 1)
+    q1 = np.cumsum(p, axis=-1)
+    m1 = np.cumsum(p * np.arange(hist.shape[-1]), axis=-1)
+    q2 = 1.0 - q1
+    eps = np.finfo(np.float32).eps
+    valid = (np.minimum(q1, q2) >= eps) & (np.maximum(q1, q2) <= 1.0 - eps)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sigma = q1 * q2 * (m1 / q1 - (m1[:, -1:] - m1) / q2)**2
+    return np.argmax(np.where(valid, sigma, 0), axis=-1)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+image metadata - capture date and dimensions read from the file header only
+(exif, jpeg frame header, png header, tiff tags), without decoding the
+image, and an on-disk index of them for whole directories.
+
+the index holds one entry per file (path, size, mtime, capture date, width,
+height). files are only read again when their size or mtime changed, so
+naming and grouping images by date needs no image I/O on re-runs. missing
+or broken exif data give date = None instead of an error - file_date is the
+fallback for naming.
+"""
+
+import io
+import os
+import re
+import json
+import time
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+# exif / tiff tags
+_WIDTH, _HEIGHT, _DATE, _EXIF_IFD = 256, 257, 306, 0x8769
+_DATE_ORIGINAL, _PIXEL_X, _PIXEL_Y = 36867, 40962, 40963
+
+# jpeg start-of-frame markers (contain the dimensions)
+_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+_DATE_RE = re.compile(r'^\s*(\d{4})[:\-/](\d{2})[:\-/](\d{2})')
+
+
+def parse_date(value):
+    """
+    exif date ("YYYY:MM:DD HH:MM:SS") as YYYYMMDD, or None if it is missing
+    or not a valid date
+    """
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'ignore')
+    m = _DATE_RE.match(value or '')
+    if not m or m.group(1) == '0000' or not ('01' <= m.group(2) <= '12') or not ('01' <= m.group(3) <= '31'):
+        return None
+    return m.group(1) + m.group(2) + m.group(3)
+
+
+def file_date(path):
+    # modification date of a file as YYYYMMDD - fallback if there is no exif date
+    return time.strftime("%Y%m%d", time.localtime(os.stat(path).st_mtime))
+
+
+def _read_at(f, offset, n):
+    f.seek(offset)
+    data = f.read(n)
+    if len(data) < n:
+        raise ValueError("unexpected end of header")
+    return data
+
+
+def _ifd(f, offset, end):
+    # tags of one tiff directory: {tag: value}, only ascii, short and long values
+    count, = struct.unpack(end + 'H', _read_at(f, offset, 2))
+    tags = {}
+    for i in range(count):
+        tag, typ, n, value = struct.unpack(end + 'HHI4s', _read_at(f, offset + 2 + 12 * i, 12))
+        if typ == 2: # ascii
+            tags[tag] = value[:n] if n <= 4 else _read_at(f, struct.unpack(end + 'I', value)[0], n)
+        elif typ == 3: # short
+            tags[tag] = struct.unpack(end + 'H', value[:2])[0]
+        elif typ == 4: # long
+            tags[tag] = struct.unpack(end + 'I', value)[0]
+    return tags
+
+
+def _tiff(f, meta):
+    # tiff structure - a tiff file or the exif block of a jpeg
+    order = _read_at(f, 0, 2)
+    if order not in (b'II', b'MM'):
+        raise ValueError("not a tiff header")
+    end = '<' if order == b'II' else '>'
+    magic, offset = struct.unpack(end + 'HI', _read_at(f, 2, 6))
+    tags = _ifd(f, offset, end)
+    if _EXIF_IFD in tags:
+        exif = _ifd(f, tags[_EXIF_IFD], end)
+        tags.update((k, v) for k, v in exif.items() if k not in tags)
+    meta['date'] = meta['date'] or parse_date(tags.get(_DATE)) or parse_date(tags.get(_DATE_ORIGINAL))
+    meta['width'] = meta['width'] or tags.get(_WIDTH) or tags.get(_PIXEL_X)
+    meta['height'] = meta['height'] or tags.get(_HEIGHT) or tags.get(_PIXEL_Y)
+
+
+def _jpeg(f, meta):
+    # walk the marker segments up to the frame header - the image data is never read
+    f.seek(2)
+    while True:
+        if f.read(1) != b'\xff':
+            return
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return
+        m = marker[0]
+        if m == 0x01 or 0xD0 <= m <= 0xD8:
+            continue
+        if m in (0xD9, 0xDA): # end of image, start of scan
+            return
+        length, = struct.unpack('>H', f.read(2))
+        if m == 0xE1 and meta['date'] is None:
+            payload = f.read(length - 2)
+            if payload.startswith(b'Exif\x00\x00'):
+                try:
+                    _tiff(io.BytesIO(payload[6:]), meta)
+                except (ValueError, struct.error):
+                    pass
+            continue
+        if m in _SOF:
+            precision, height, width = struct.unpack('>BHH', f.read(5))
+            meta['width'], meta['height'] = width, height
+            return
+        f.seek(length - 2, 1)
+
+
+def _pil(f, meta):
+    # other formats: pillow reads the header when opening, and decodes only on access
+    from PIL import Image
+    f.seek(0)
+    img = Image.open(f)
+    meta['width'], meta['height'] = img.size
+    exif = img.getexif()
+    meta['date'] = parse_date(exif.get(_DATE))
+
+
+def read_header(source):
+    """
+    capture date (exif, as YYYYMMDD) and dimensions of an image, from a path
+    or a binary file object. returns a dict with date, width and height -
+    values that can't be read are None
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    f = open(source, 'rb') if isinstance(source, str) else source
+    meta = dict(date = None, width = None, height = None)
+    try:
+        start = f.read(8)
+        if start[:2] == b'\xff\xd8':
+            _jpeg(f, meta)
+        elif start[:4] in (b'II*\x00', b'MM\x00*'):
+            _tiff(f, meta)
+        elif start == b'\x89PNG\r\n\x1a\n':
+            meta['width'], meta['height'] = struct.unpack('>II', _read_at(f, 16, 8))
+        else:
+            _pil(f, meta)
+    except Exception:
+        pass # broken or unknown header - keep what was found
+    finally:
+        if f is not source:
+            f.close()
+    return meta
+
+
+def _entry(path, st):
+    entry = read_header(path)
+    entry.update(path = path, size = st.st_size, mtime_ns = st.st_mtime_ns)
+    return entry
+
+
+class MetadataIndex(object):
+    """
+    json file with the metadata of images, one entry per file (keyed by the
+    absolute path). entries are re-read only if size or mtime of the file
+    changed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._changed = False
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f).get('entries', {})
+
+    def _fresh(self, path, st):
+        entry = self.entries.get(path)
+        return entry if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns else None
+
+    def get(self, path):
+        # entry of one file (read from its header if it is new or changed)
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = self._fresh(path, st)
+        if entry is None:
+            entry = self.entries[path] = _entry(path, st)
+            self._changed = True
+        return entry
+
+    def scan(self, directory, extensions=IMAGE_EXTENSIONS, recursive=True, n_threads=8):
+        """
+        entries of all images in directory, sorted by path. headers of new
+        and changed files are read by n_threads threads (reading headers is
+        mostly waiting for the disk), and the index is saved if anything
+        changed
+        """
+        found = []
+        dirs = [os.path.abspath(directory)]
+        while dirs:
+            with os.scandir(dirs.pop()) as it:
+                for e in it:
+                    if e.is_dir():
+                        if recursive:
+                            dirs.append(e.path)
+                    elif e.name.lower().endswith(extensions):
+                        found.append((e.path, e.stat()))
+
+        stale = [(p, st) for p, st in found if self._fresh(p, st) is None]
+        if stale:
+            with ThreadPoolExecutor(n_threads) as pool:
+                for entry in pool.map(lambda item: _entry(*item), stale):
+                    self.entries[entry['path']] = entry
+            self._changed = True
+        if self._changed:
+            self.save()
+        return sorted((self.entries[p] for p, st in found), key=lambda e: e['path'])
+
+    def date(self, path):
+        # capture date of a file, or its modification date if it has none
+        return self.get(path)['date'] or file_date(path)
+
+    def by_date(self, entries=None):
+        """
+        paths grouped by capture date: {YYYYMMDD: [paths]}. files without
+        exif date are grouped by their modification date
+        """
+        groups = {}
+        for e in (self.entries.values() if entries is None else entries):
+            groups.setdefault(e['date'] or file_date(e['path']), []).append(e['path'])
+        return groups
+
+    def save(self):
+        # atomic, like Manifest.save
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(version = 1, entries = self.entries), f)
+        os.replace(tmp, self.path)
+        self._changed = False
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+structuring elements for the morphology operations of both procedures,
+built once per process and shared (read-only) instead of once per image.
+the operations themselves are opencv's (cv2.erode, cv2.dilate and
+cv2.morphologyEx) - it already folds iterated rectangles into one kernel and
+splits them into row and column passes, and a decomposition in python was
+not faster for any of the kernels used here.
+"""
+
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+
+def structuring_element(shape, ksize):
+    """
+    cv2.getStructuringElement(shape, ksize), built once per process and
+    shared - the returned array is read-only
+    """
+    return _element(shape, tuple(ksize))
+
+
+def ones(shape):
+    # np.ones(shape, np.uint8) as a shared, read-only kernel
+    return _element(None, tuple(shape))
+
+
+@lru_cache(maxsize=None)
+def _element(shape, size):
+    if shape is None:
+        kernel = np.ones(size, np.uint8)
+    else:
+        kernel = cv2.getStructuringElement(shape, size)
+    kernel.flags.writeable = False
+    return kernel
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+pipeline objects - the camera and scanner procedures as reusable objects
+for embedding in other programs (job runners, services, notebooks):
+
+    from iso_cv import CameraPipeline
+    pipe = CameraPipeline(dict(scale = 70))
+    rec = pipe.process(img)                  # one image (numpy array)
+    for res in pipe.process_many(paths, n_workers = 4):
+        ...
+
+all setup happens once, when the object is made: the parameters are
+checked, and the buffers for gray conversion and resizing are kept and
+reused for images of the same size. process_many on a process pool builds
+one pipeline per worker, which then handles all of its images.
+"""
+
+import os
+import cv2
+import numpy as np
+
+from . import camera, scanner
+from .batch import FINAL, run_batch, resolve_workers
+from .control import finish_process_writers, open_control
+
+
+class Scratch(object):
+    """
+    reusable output arrays, allocated on first use and again only when the
+    shape or type changes. arrays handed out are overwritten by the next
+    image - anything that is kept must be copied
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = self._buffers[name] = np.empty(shape, dtype)
+        return buf
+
+
+class _Pipeline(object):
+    # common part: gray conversion, process_many, and rebuilding in workers
+
+    def __init__(self, params, **options):
+        self.params = self.get_params(params)
+        self.options = options
+        self.scratch = Scratch()
+
+    def to_gray(self, img):
+        # 8-bit gray image (no copy if it is one already)
+        if img.ndim == 2:
+            return img
+        code = cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        return cv2.cvtColor(img, code, dst = self.scratch.get('gray', img.shape[:2]))
+
+    def load(self, path):
+        img = cv2.imread(path)
+        if img is None:
+            raise IOError("could not read image: " + path)
+        return img
+
+    def _process_item(self, item, control_dir=None, control=None):
+        if not isinstance(item, str):
+            return self.process(item)
+        result, view = self.analyse(self.load(item))
+        if control_dir:
+            # images without result get a control image as well (the plain
+            # image) - they are always flagged
+            control = open_control(control)
+            control.submit(os.path.join(control_dir, self.control_name(item)), self.control_image, view, result,
+                           flagged = result is None or control.flagged(result))
+        return result
+
+    def process(self, img):
+        return self.analyse(img)[0]
+
+    def process_many(self, items, n_workers=1, control_dir=None, control=None, max_pending=None):
+        """
+        process every item (image array or path) and yield a BatchResult per
+        item, in order (see batch.run_batch) - a failing image does not stop
+        the others. with control_dir, control images of the items given as
+        paths are written there, as control (a control.ControlWriter)
+        decides. with n_workers > 1 (None = all cores), items are spread
+        over worker processes, each with its own copy of this pipeline (and
+        writer) - control images that fail there are added to
+        control.errors as later results arrive, the last ones when all
+        items are done
+        """
+        if resolve_workers(n_workers) == 1:
+            return run_batch(self._process_item, items, n_workers = 1, args = (control_dir, control))
+        results = run_batch(_process_item, items, n_workers = n_workers, args = (control_dir, control), max_pending = max_pending,
+                            initializer = _init_worker, initargs = (type(self), self.params, self.options),
+                            finalizer = None if control is None else finish_process_writers)
+        return _collect(results, control)
+
+
+class CameraPipeline(_Pipeline):
+    """
+    camera procedure (see camera.py): gray conversion, resizing and
+    background correction (normalize = False skips these, for images that
+    are already histogram adjusted), then ROI detection and measurement
+    """
+    columns = camera.COLUMNS
+    get_params = staticmethod(camera.get_params)
+
+    def __init__(self, params=None, ref=240, resize=0.5, normalize=True):
+        _Pipeline.__init__(self, params, ref = ref, resize = resize, normalize = normalize)
+
+    def gray(self, img):
+        """
+        normalized gray image of a raw camera image, like
+        camera.normalize_file (without writing it)
+        """
+        gray = self.to_gray(img)
+        if not self.options['normalize']:
+            return gray
+        r = self.options['resize']
+        if r != 1:
+            shape = (int(round(gray.shape[0] * r)), int(round(gray.shape[1] * r)))
+            gray = cv2.resize(gray, (0,0), dst = self.scratch.get('small', shape), fx = r, fy = r)
+        return camera.normalize_gray(gray, self.options['ref'])
+
+    def analyse(self, img):
+        """
+        measurements of one image (numpy array) and its ROI: (record, roi).
+        the record is a dict with contour, circle, length, area, mean and sd
+        (see camera.analyse_roi) plus the ROI ("roi"), or None if no isopod
+        was found. process returns only the record
+        """
+        roi, rec = camera.analyse_gray(self.gray(img), self.params)
+        roi = roi.copy()
+        if rec is not None:
+            rec['roi'] = roi
+        return rec, roi
+
+    def row(self, name, rec):
+        return camera.result_row(name, rec, self.params)
+
+    def control_image(self, roi, rec, scale=1):
+        return camera.control_image(roi, rec, scale)
+
+    def control_name(self, path):
+        return os.path.basename(path)
+
+
+class ScannerPipeline(_Pipeline):
+    """
+    scanner procedure (see scanner.py): detection of all objects on the
+    scan, then segmentation and measurement of each (with the engine set in
+    the parameters)
+    """
+    columns = scanner.COLUMNS
+    get_params = staticmethod(scanner.get_params)
+
+    def __init__(self, params=None):
+        _Pipeline.__init__(self, params)
+
+    def analyse(self, img):
+        """
+        measurements of all objects on a scan (numpy array) and the scan:
+        (records, img) - a list of records, see scanner.analyse_scan.
+        process returns only the records
+        """
+        return scanner.analyse_scan(self.to_gray(img), self.params), img
+
+    def rows(self, records):
+        return [scanner.result_row(rec) for rec in records]
+
+    def control_image(self, img, records, scale=1):
+        # same control image as scanner.process_scan - the gray image of
+        # process is a scratch buffer that the next image overwrites, so it
+        # is converted again here
+        return scanner.control_image(img, cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), records, scale)
+
+    def control_name(self, path):
+        return os.path.splitext(os.path.basename(path))[0] + '_output.jpg'
+
+
+# worker side of process_many - one pipeline per worker process
+_worker = None
+
+def _init_worker(cls, params, options):
+    global _worker
+    _worker = cls(params, **options)
+
+
+def _process_item(item, control_dir=None, control=None):
+    """
+    returns the result and the control images of the worker that could not
+    be written so far - the writer of the worker (see
+    ControlWriter.__reduce__) is not the one of the main process, so its
+    errors are sent back with the results (see _collect). the item's own
+    control image is still being written, its error (if any) comes with a
+    later result or from finish_process_writers after the last item
+    """
+    result = _worker._process_item(item, control_dir, control)
+    return result, [] if control is None else control.take_errors()
+
+
+def _collect(results, control):
+    # results of the workers: control image errors go to the errors of
+    # control, the results of the finalizer are not passed on
+    for res in results:
+        if res.item is FINAL:
+            if res.error is not None:
+                control.errors.append((None, res.error))
+            else:
+                control.errors.extend(res.value)
+            continue
+        if res.error is None:
+            value, errors = res.value
+            if control is not None:
+                control.errors.extend(errors)
+            res = res._replace(value = value)
+        yield res
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+stage-level instrumentation - wall time, cpu time and (optionally) peak
+memory of every processing stage of every image.
+
+the procedures mark their stages with
+
+    with profiling.stage("threshold"):
+        ...
+
+which records into the currently active profiler (see activate). without an
+active profiler this is a no-op that costs one function call. run_batch
+(batch.py) activates a profiler in the workers when called with profile =
+True and sends the records back with the results.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class NullProfiler(object):
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def image(self, name):
+        return _NULL_STAGE
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class _Stage(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        peak = self.profiler._exit()
+        self.profiler.records.append(dict(image = self.profiler.current_image, stage = self.name,
+                                          wall = wall, cpu = cpu, peak = peak))
+        return False
+
+
+class Profiler(object):
+    """
+    collects one record (image, stage, wall, cpu, peak) per executed stage.
+    with memory = True, peak is the highest memory allocated through python
+    and numpy (including opencv results) during the stage, in bytes, taken
+    with tracemalloc - this slows processing down noticeably, so it is off
+    by default (peak is then None)
+    """
+    enabled = True
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = []
+        self.current_image = None
+        self._mem_stack = []
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    @contextmanager
+    def image(self, name):
+        # everything recorded inside belongs to image name, plus a "total" stage
+        previous, self.current_image = self.current_image, name
+        try:
+            with self.stage("total"):
+                yield self
+        finally:
+            self.current_image = previous
+
+    # memory tracking for nested stages: tracemalloc has a single peak, so
+    # the peak of an inner stage is handed on to its parent before reset
+    def _enter(self):
+        if not self.memory:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._mem_stack:
+            self._mem_stack[-1][1] = max(self._mem_stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        self._mem_stack.append([current, current])
+
+    def _exit(self):
+        if not self.memory:
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        start, child_peak = self._mem_stack.pop()
+        peak = max(peak, child_peak)
+        if self._mem_stack:
+            self._mem_stack[-1][1] = max(self._mem_stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        return peak - start
+
+    def add(self, records):
+        # merge records from another profiler (e.g. sent back by a worker)
+        if records:
+            self.records.extend(records)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        per stage: number of calls, total and mean wall time, wall time
+        percentiles, total cpu time and the maximum peak memory
+        """
+        stages = {}
+        for rec in self.records:
+            stages.setdefault(rec['stage'], []).append(rec)
+        summary = []
+        for name, recs in stages.items():
+            wall = np.array([r['wall'] for r in recs])
+            peaks = [r['peak'] for r in recs if r['peak'] is not None]
+            entry = dict(stage = name, n = len(recs), wall_total = float(wall.sum()),
+                         wall_mean = float(wall.mean()), cpu_total = float(sum(r['cpu'] for r in recs)),
+                         peak_max = max(peaks) if peaks else None)
+            for q in percentiles:
+                entry['wall_p%d' % q] = float(np.percentile(wall, q))
+            summary.append(entry)
+        return sorted(summary, key=lambda e: -e['wall_total'])
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(dict(summary = self.summary(), records = self.records), f, indent=1)
+
+    def to_csv(self, path):
+        summary = self.summary()
+        if not summary:
+            return
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(summary[0].keys()), lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(summary)
+
+    def save(self, path):
+        # run report - json (summary and all records) or csv (summary) by extension
+        if os.path.splitext(path)[1].lower() == '.csv':
+            self.to_csv(path)
+        else:
+            self.to_json(path)
+
+
+_active = [NULL_PROFILER]
+
+
+def current():
+    return _active[-1]
+
+
+def stage(name):
+    # context manager that records stage name into the active profiler
+    return _active[-1].stage(name)
+
+
+@contextmanager
+def activate(profiler):
+    # make profiler the one that stage() records into
+    _active.append(profiler or NULL_PROFILER)
+    try:
+        yield profiler
+    finally:
+        _active.pop()
+
+
+class Progress(object):
+    """
+    live progress line with throughput (images/s) and estimated time left,
+    updated at most every interval seconds
+    """
+
+    def __init__(self, total, interval=1.0, stream=None):
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.done = 0
+        self.start = self._last = time.perf_counter()
+
+    def update(self, n=1):
+        self.done += n
+        now = time.perf_counter()
+        if now - self._last >= self.interval or self.done >= self.total:
+            self._last = now
+            self.stream.write("\r" + self.status(now))
+            if self.done >= self.total:
+                self.stream.write("\n")
+            self.stream.flush()
+
+    def status(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else float('nan')
+        if eta == eta:
+            eta = "%d:%02d" % divmod(int(eta), 60)
+        else:
+            eta = "?"
+        return "%d/%d images, %.2f images/s, ETA %s" % (self.done, self.total, rate, eta)
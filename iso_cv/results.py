@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+results sinks - buffered writing of result tables.
+
+rows are written as they come (or in batches, see flush_every), and the
+cost of writing a row does not grow with the size of the table. sinks with
+a key column keep an index of the rows they hold, so writing a row whose
+key already exists replaces it (upsert) without re-reading the file.
+replace_group replaces all rows of e.g. a scan at once, also when it now
+has fewer objects. the backend is picked from the file extension (see open_sink):
+
+    .txt, .tsv      tab separated text (the format of the original scripts)
+    .csv            comma separated text
+    .parquet        parquet (needs pandas and pyarrow)
+    .feather        feather (needs pandas and pyarrow)
+    .sqlite, .db    sqlite database with a "results" table
+"""
+
+import os
+import abc
+import csv
+import json
+import sqlite3
+
+
+def _plain(value):
+    # numpy scalars -> python values (sqlite can't store numpy integers)
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _text(value):
+    # missing values (None or nan) are written as NA in text files
+    value = _plain(value)
+    if value is None or (isinstance(value, float) and value != value):
+        return 'NA'
+    return str(value)
+
+
+class ResultSink(abc.ABC):
+    """
+    base class. rows are sequences in the order of columns (or dicts with
+    the column names as keys). key is the name of the key column, a tuple
+    of names for composite keys, or None for an append-only table.
+    flush_every is the number of rows buffered before they are written -
+    with the default of 1, every row is on disk when write returns, as in
+    the original scripts (None = only on flush/close).
+    """
+
+    def __init__(self, path, columns, key=None, flush_every=1):
+        self.path = path
+        self.columns = list(columns)
+        self.key = key
+        self.flush_every = flush_every
+        if key is None:
+            self._key_idx = None
+        elif isinstance(key, str):
+            self._key_idx = (self.columns.index(key),)
+        else:
+            self._key_idx = tuple(self.columns.index(k) for k in key)
+        self._pending = []
+
+    def _row(self, row):
+        if isinstance(row, dict):
+            row = [row.get(c) for c in self.columns]
+        if len(row) != len(self.columns):
+            raise ValueError("row has %d values, expected %d" % (len(row), len(self.columns)))
+        return list(row)
+
+    def row_key(self, row):
+        key = tuple(str(row[i]) for i in self._key_idx)
+        return key[0] if len(key) == 1 else key
+
+    def write(self, row):
+        self._pending.append(self._row(row))
+        self._check()
+
+    def write_many(self, rows):
+        # all rows of one call are written together
+        self._pending.extend(self._row(row) for row in rows)
+        self._check()
+
+    def replace_group(self, value, rows):
+        """
+        write rows in place of all rows whose (first) key column is value -
+        e.g. all objects of a scan that is processed again, also when fewer
+        are found now. rows buffered before are flushed first, rows are
+        written right away
+        """
+        if self.key is None:
+            raise ValueError("replace_group needs a key")
+        self.flush()
+        self._store_group(value, [self._row(row) for row in rows])
+
+    def _check(self):
+        if self.flush_every and len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            rows, self._pending = self._pending, []
+            self._store(rows)
+
+    @abc.abstractmethod
+    def _store(self, rows):
+        # write the buffered rows to the backend
+        pass
+
+    @abc.abstractmethod
+    def _store_group(self, value, rows):
+        # remove the rows of group value from the backend and write rows
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _TableSink(ResultSink):
+    # sinks that keep the rows in memory when a key is used, to know which
+    # rows a new one replaces. removed rows leave a None in _rows until the
+    # table is packed
+
+    def __init__(self, path, columns, key=None, flush_every=1):
+        ResultSink.__init__(self, path, columns, key, flush_every)
+        self._index = {}
+        self._groups = {} # value of the first key column -> keys
+        self._rows = []
+        self._stale = 0
+        self._written = False
+
+    def _upsert(self, row):
+        key = self.row_key(row)
+        if key in self._index:
+            self._rows[self._index[key]] = row
+            self._stale += 1
+        else:
+            self._index[key] = len(self._rows)
+            self._rows.append(row)
+            self._groups.setdefault(key[0] if isinstance(key, tuple) else key, []).append(key)
+
+    def _remove_group(self, value):
+        # removes the rows of a group, returns their keys
+        keys = self._groups.pop(str(_plain(value)), [])
+        for key in keys:
+            self._rows[self._index.pop(key)] = None
+        self._stale += len(keys)
+        return keys
+
+    def _pack(self):
+        # close the gaps of removed rows
+        if self.key is not None and len(self._rows) > len(self._index):
+            self._rows = [row for row in self._rows if row is not None]
+            self._index = dict((self.row_key(row), i) for i, row in enumerate(self._rows))
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key):
+        if key in self._index:
+            return self._rows[self._index[key]]
+
+    def _replace(self, tmp):
+        # atomic swap of the new file for the old one
+        os.replace(tmp, self.path)
+
+
+class TextSink(_TableSink):
+    """
+    delimited text file with a header line. rows are only ever appended -
+    a row that replaces an earlier one (same key) is appended as well, and
+    the last row of a key wins when the file is read again. the file is
+    rewritten without the replaced rows when they outnumber the current
+    ones, and on close, so the cost per row stays constant. it is also
+    rewritten right away when replace_group removes rows that are not
+    written again
+    """
+    delimiter = '\t'
+
+    def __init__(self, path, columns, key=None, flush_every=1):
+        _TableSink.__init__(self, path, columns, key, flush_every)
+        self._dropped = set() # removed keys that are still in the file
+        if self.key is not None and os.path.isfile(path) and os.path.getsize(path) > 0:
+            for row in self._read():
+                self._upsert(row)
+
+    def _read(self):
+        with open(self.path, 'r', newline='') as f:
+            reader = csv.reader(f, delimiter=self.delimiter)
+            header = next(reader)
+            if header != self.columns:
+                raise ValueError("columns of %s don't match: %s" % (self.path, header))
+            return [row for row in reader if row]
+
+    def _writerows(self, f, rows):
+        writer = csv.writer(f, delimiter=self.delimiter, lineterminator='\n')
+        writer.writerows([[_text(v) for v in row] for row in rows])
+
+    def _store(self, rows):
+        self._written = True
+        if self.key is not None:
+            for row in rows:
+                self._upsert(row)
+        header = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as f:
+            if header:
+                self._writerows(f, [self.columns])
+            self._writerows(f, rows)
+        if self._dropped or self._stale > len(self._index):
+            self._compact()
+
+    def _store_group(self, value, rows):
+        self._dropped.update(self._remove_group(value))
+        self._dropped.difference_update(self.row_key(row) for row in rows)
+        self._store(rows)
+
+    def _compact(self):
+        self._pack()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', newline='') as f:
+            self._writerows(f, [self.columns])
+            self._writerows(f, self._rows)
+        self._replace(tmp)
+        self._stale = 0
+        self._dropped = set()
+
+    def close(self):
+        # a sink that wrote nothing leaves the file as it is
+        self.flush()
+        if self._written and self._stale:
+            self._compact()
+
+
+class CsvSink(TextSink):
+    delimiter = ','
+
+
+class FrameSink(_TableSink):
+    """
+    parquet or feather file, written through pandas. these formats can't be
+    appended to, so the table is held in memory and written on close. until
+    then, rows go to a journal next to it (path + ".journal", one json line
+    per row, and one per replace_group), which is read back if a run
+    stopped before closing the sink
+    """
+
+    def __init__(self, path, columns, key=None, flush_every=1, fmt='parquet'):
+        try:
+            import pandas
+        except ImportError:
+            raise ImportError("writing " + fmt + " files requires pandas and pyarrow")
+        self._pd = pandas
+        self.fmt = fmt
+        self.journal = path + '.journal'
+        _TableSink.__init__(self, path, columns, key, flush_every)
+        if os.path.isfile(path):
+            self._add(self._read())
+        if os.path.isfile(self.journal):
+            for entry in self._read_journal():
+                if isinstance(entry, dict):
+                    self._remove_group(entry['group'])
+                else:
+                    self._add([entry])
+            self._written = True
+
+    def _read(self):
+        if self.fmt == 'feather':
+            df = self._pd.read_feather(self.path)
+        else:
+            df = self._pd.read_parquet(self.path)
+        return df[self.columns].values.tolist()
+
+    def _read_journal(self):
+        # rows, and {"group": value} where the rows of a group were removed
+        rows = []
+        with open(self.journal, 'r') as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    pass # last line of a run that was killed while writing it
+        return rows
+
+    def _add(self, rows):
+        if self.key is None:
+            self._rows.extend(rows)
+        else:
+            for row in rows:
+                self._upsert(row)
+
+    def _store(self, rows):
+        self._written = True
+        self._add(rows)
+        with open(self.journal, 'a') as f:
+            for row in rows:
+                f.write(json.dumps([_plain(v) for v in row]) + '\n')
+
+    def _store_group(self, value, rows):
+        self._remove_group(value)
+        with open(self.journal, 'a') as f:
+            f.write(json.dumps(dict(group = _plain(value))) + '\n')
+        self._store(rows)
+
+    def close(self):
+        self.flush()
+        if self._written:
+            self._pack()
+            df = self._pd.DataFrame([[_plain(v) for v in row] for row in self._rows], columns=self.columns)
+            tmp = self.path + '.tmp'
+            if self.fmt == 'feather':
+                df.to_feather(tmp)
+            else:
+                df.to_parquet(tmp, index=False)
+            self._replace(tmp)
+            os.remove(self.journal)
+            self._written = False
+
+
+class SqliteSink(ResultSink):
+    """
+    sqlite database - rows go to the table "results". with a key, the key
+    columns are the primary key and rows are upserted. each flush is one
+    transaction
+    """
+
+    def __init__(self, path, columns, key=None, flush_every=1, table='results'):
+        ResultSink.__init__(self, path, columns, key, flush_every)
+        self.table = table
+        self.con = sqlite3.connect(path)
+        cols = ', '.join('"%s"' % c for c in self.columns)
+        if key is not None:
+            keys = [self.columns[i] for i in self._key_idx]
+            cols += ', PRIMARY KEY (%s)' % ', '.join('"%s"' % k for k in keys)
+        self.con.execute('CREATE TABLE IF NOT EXISTS "%s" (%s)' % (table, cols))
+        self.con.commit()
+
+    def _insert(self, rows):
+        verb = 'INSERT' if self.key is None else 'INSERT OR REPLACE'
+        sql = '%s INTO "%s" VALUES (%s)' % (verb, self.table, ', '.join('?' * len(self.columns)))
+        self.con.executemany(sql, [[_plain(v) for v in row] for row in rows])
+
+    def _store(self, rows):
+        with self.con:
+            self._insert(rows)
+
+    def _store_group(self, value, rows):
+        # one transaction: the old rows are never gone without the new ones
+        with self.con:
+            self.con.execute('DELETE FROM "%s" WHERE "%s" = ?' % (self.table, self.columns[self._key_idx[0]]),
+                             (_plain(value),))
+            self._insert(rows)
+
+    def close(self):
+        self.flush()
+        self.con.close()
+
+
+def open_sink(path, columns, key=None, **kwargs):
+    """
+    results sink for path, with the backend chosen by the file extension
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.txt', '.tsv'):
+        return TextSink(path, columns, key, **kwargs)
+    if ext == '.csv':
+        return CsvSink(path, columns, key, **kwargs)
+    if ext in ('.parquet', '.feather'):
+        return FrameSink(path, columns, key, fmt=ext[1:], **kwargs)
+    if ext in ('.sqlite', '.db'):
+        return SqliteSink(path, columns, key, **kwargs)
+    raise ValueError("unknown results format: " + ext)
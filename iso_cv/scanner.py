@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+"""
+scanner procedure - the per-image body of iso-cv-scanner.py as functions that
+can be handed to a worker pool (see batch.py)
+"""
+
+import os
+import math
+import cv2
+import numpy as np
+
+from .batch import run_batch
+from .cache import NULL_CACHE, open_cache
+from . import morphology, profiling
+from .control import open_control, resized
+from .measure import masked_stats, label_histograms, label_stats, otsu_thresholds
+from .tiles import TiledScan
+
+# columns of the per-image results text file
+COLUMNS = ['PyLabel', 'X', 'Y', 'Length', 'Area', 'Mean', 'StdDev', 'Min', 'Max']
+
+# default detection and phenotyping parameters - see iso-cv-scanner.py for
+# what they do
+DEFAULTS = dict(
+    det_len_val = 100,
+    det_kern_close = (5,5),
+    det_it_close = 3,
+    det_kern_open = (7,7),
+    det_it_open = 5,
+    rec_kern_close_fac = 1,
+    rec_it_close_fac = 1,
+    rec_kern_open_fac = 1,
+    rec_it_open_fac = 1,
+    roi_margin = 100, # pixels added around the bounding rectangle of each object
+    engine = "roi", # "roi" (measure_roi) or "labels" (measure_labels, opt-in - slower on typical scans)
+    scale = 94.6876, # pixels per mm
+    )
+
+
+def get_params(params=None):
+    p = dict(DEFAULTS)
+    p.update(params or {})
+    return p
+
+
+# =============================================================================
+# i) find ROIs in image
+# =============================================================================
+
+def detect(gray, params):
+    """
+    threshold (Otsu) and clean up the whole scan - returns the binary image
+    the objects are searched in
+    """
+    with profiling.stage("threshold"):
+        ret, thresh = cv2.threshold(gray,0,255,cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
+
+# cleanup - "closing operation" with rectangle-shaped kernel, "opening operation" with cross-shaped kernel - good for removing legs
+    with profiling.stage("morphology"):
+        kernel1 = morphology.structuring_element(cv2.MORPH_RECT,params['det_kern_close'])
+        kernel2 = morphology.structuring_element(cv2.MORPH_CROSS,params['det_kern_open'])
+        morph1 = cv2.morphologyEx(thresh,cv2.MORPH_CLOSE,kernel1, iterations = params['det_it_close'])
+        morph2 = cv2.morphologyEx(morph1,cv2.MORPH_OPEN,kernel2, iterations = params['det_it_open'])
+    return morph2
+
+
+def approx_length(cnt):
+    # approximate shape length (mean of the circle-equivalent diameter and the longer ellipse axis)
+    center,axes,orientation = cv2.fitEllipse(cnt)
+    return np.mean([math.sqrt(axes[1]*axes[0]*math.pi),max(axes)])
+
+
+def find_objects(morph, params):
+    """
+    returns a list of (bounding rectangle, approximate length) of all
+    objects that pass the size filters
+    """
+    with profiling.stage("contours"):
+        contours, hierarchy = cv2.findContours(morph.copy(),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_TC89_L1)[-2:]
+    return [(cv2.boundingRect(cnt), L) for cnt, L in _size_filter(contours, params)]
+
+
+def _size_filter(contours, params):
+    # (contour, approximate length) of the contours that pass the size filters
+    objects = []
+    for cnt in contours:
+# exclude small contours (fewer than 50 points - isopods are complex structures that will a lot of points)
+        if len(cnt) > 50:
+            L = approx_length(cnt)
+            if L > params['det_len_val']:
+                objects.append((cnt, L))
+    return objects
+
+
+def find_objects_tiled(scan, params):
+    """
+    find_objects for a TiledScan - detection runs band by band, and the
+    contour of every object is traced within its bounding box
+    """
+    boxes = scan.detect(params)
+    with profiling.stage("contours"):
+        contours = [scan.contour(box) for box in boxes]
+    # same order as findContours on the whole image (by the first point, from the bottom)
+    contours.sort(key=lambda cnt: (cnt[0][0][1], cnt[0][0][0]), reverse=True)
+    return [(cv2.boundingRect(cnt), L) for cnt, L in _size_filter(contours, params)]
+
+
+def roi_box(rect, shape, margin):
+    # ROI coordinates (x0, y0, x1, y1) of a bounding rectangle plus margin, clipped to the image
+    rx,ry,w,h = rect
+    return (max(0,rx-margin), max(0,ry-margin), min(shape[1],rx+w+margin), min(shape[0],ry+h+margin))
+
+
+# =============================================================================
+# ii) work with ROI
+# =============================================================================
+
+def roi_morphology(L, params):
+    """
+    adaptive kernel size and number of iterations of morphology-operations -
+    bigger kernels and more iterations for large isopods, smaller kernels and
+    fewer iterations for small ones. returns (k3, niter3, k4, niter4)
+    """
+    if L > 600:
+        k3 = 3; niter3 = int(round(L * 0.005) -4)  * params['rec_kern_close_fac']
+        k4 = 9; niter4 = int(round(L * 0.007))   * params['rec_it_close_fac']
+    else:
+        k3 = 3; niter3 = int(round(L * 0.015) - 4)  * params['rec_kern_open_fac']
+        k4 = 5; niter4 = int(round(L * 0.03) - 8) *  params['rec_it_open_fac']
+    # factors may be fractional, iterations have to be whole numbers
+    return k3, int(round(niter3)), k4, int(round(niter4))
+
+
+def measure_roi(roi, L, params):
+    """
+    segment the isopod inside one ROI and measure it. returns a dict with
+    the contour ("shape", in ROI coordinates), the enclosing circle and the
+    raw metrics, or None if nothing was found
+    """
+    with profiling.stage("roi_threshold"):
+        ret, roi_thresh = cv2.threshold(roi,0,255,cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
+
+    with profiling.stage("roi_morphology"):
+        k3, niter3, k4, niter4 = roi_morphology(L, params)
+        kernel3 = morphology.structuring_element(cv2.MORPH_RECT,(k3,k3))
+        morph3 = cv2.morphologyEx(roi_thresh,cv2.MORPH_CLOSE,kernel3, iterations = niter3)
+        kernel4 = morphology.structuring_element(cv2.MORPH_CROSS,(k4,k4))
+        morph4 = cv2.morphologyEx(morph3,cv2.MORPH_OPEN,kernel4, iterations = niter4)
+
+# create contour, centroid, and min. circle diameter (for length)
+    with profiling.stage("roi_contours"):
+        contours, hierarchy = cv2.findContours(morph4.copy(),cv2.RETR_LIST ,cv2.CHAIN_APPROX_TC89_L1)[-2:]
+        if not contours:
+            return None
+        areas = [cv2.contourArea(cnt) for cnt in contours]
+        shape = contours[int(np.argmax(areas))]
+        M = cv2.moments(shape)
+        if M['m00'] == 0:
+            return None
+        (cx,cy),radius = cv2.minEnclosingCircle(shape)
+
+# create the mask (the "cookie-cutter") and calculate gray value metrics for the pixels inside it
+    with profiling.stage("roi_stats"):
+        mask = np.zeros_like(morph4)
+        mask = cv2.drawContours(mask, [shape], 0, 255, -1)
+        mask = cv2.erode(mask,morphology.ones((5,5)),iterations = 1)
+        stats = masked_stats(roi, mask) or (np.nan,) * 4
+
+    return dict(
+        shape = shape,
+        circle = ((cx,cy), radius),
+        centroid = (M['m10']/M['m00'], M['m01']/M['m00']),
+        length = (int(radius) * 2)/params['scale'],
+        area = (cv2.contourArea(shape)/params['scale'])/params['scale'],
+        mean = stats[0],
+        sd = stats[1],
+        min = stats[2],
+        max = stats[3],
+        )
+
+
+def _measure_task(task, params):
+    roi, L = task
+    return measure_roi(roi, L, params)
+
+
+def analyse_scan(gray, params=None, n_workers=1, cache=None, key=None):
+    """
+    full procedure for one grayscale scan: detection, then segmentation and
+    measurement inside every ROI. this is a pure function of the image and
+    parameters. returns a list of records (dicts) with the label, the ROI box
+    and the measurements (see measure_roi)
+
+    with n_workers > 1 the ROIs of this scan are measured on a process pool
+    (only useful if the scans themselves are not already processed in
+    parallel). with a stage cache (and the key of the gray image), the
+    detection result is cached by the detection parameters. with params
+    engine = "labels", all objects are measured together (see measure_labels)
+    """
+    params = get_params(params)
+    if params['engine'] not in ("roi", "labels"):
+        raise ValueError("unknown engine: %r (roi or labels)" % (params['engine'],))
+    cache = cache or NULL_CACHE
+    det = tuple(params[k] for k in ('det_kern_close', 'det_it_close', 'det_kern_open', 'det_it_open'))
+    morph_key, morph = cache.stage('detect', (key, det), detect, gray, params)
+    if params['engine'] == "labels":
+        return measure_labels(gray, morph, params)
+    objects = find_objects(morph, params)
+    return measure_objects(objects, gray.shape, lambda b: gray[b[1]:b[3],b[0]:b[2]], params, n_workers)
+
+
+def analyse_scan_tiled(scan, params=None, n_workers=1):
+    """
+    analyse_scan for a TiledScan (see tiles.py) - same records, but the
+    scan is never held in memory as a whole: ROIs are read from disk one
+    at a time, when they are measured. always uses the "roi" engine
+    """
+    params = get_params(params)
+    objects = find_objects_tiled(scan, params)
+    return measure_objects(objects, scan.shape, scan.crop, params, n_workers)
+
+
+def measure_objects(objects, shape, crop, params, n_workers=1):
+    """
+    measure every object (see find_objects) in its ROI. crop returns the gray
+    image within a box (x0, y0, x1, y1) and is called only when the ROI is
+    needed
+    """
+    boxes = [roi_box(rect, shape, params['roi_margin']) for rect, L in objects]
+    tasks = ((crop(box), L) for box, (rect, L) in zip(boxes, objects))
+
+    records = []
+    results = run_batch(_measure_task, tasks, n_workers=n_workers, args=(params,))
+    for idx, (box, res) in enumerate(zip(boxes, results), 1):
+        if res.error:
+            raise RuntimeError(res.error)
+        if res.value is None:
+            continue
+        rec = dict(res.value, label = idx, box = box)
+        rec['X'] = int(rec['centroid'][0] + box[0])
+        rec['Y'] = int(rec['centroid'][1] + box[1])
+        records.append(rec)
+    return records
+
+
+# =============================================================================
+# ii b) work with all objects at once
+# =============================================================================
+
+def measure_labels(gray, morph, params):
+    """
+    alternative to measuring every object in its own ROI: all objects of the
+    scan are segmented and measured together, on label images. every pixel
+    within roi_margin of a detected object belongs to the zone of the
+    nearest object, each zone is thresholded with its own Otsu value, and
+    the size-dependent morphology (see roi_morphology) runs once per group
+    of objects with the same kernels and iterations, not once per object.
+    returns the same records as analyse_scan - Area is the pixel count of
+    the object, which is slightly larger than the contour area of the ROI
+    engine
+
+    every step passes over the whole scan, not only the pixels around the
+    animals, so this is slower than the ROI engine unless the animals cover
+    most of the scan: 1.6 s against 0.2 s for 40 animals on an A4 scan at
+    600 dpi. it is opt-in (params engine = "labels")
+    """
+    with profiling.stage("contours"):
+        contours, hierarchy = cv2.findContours(morph.copy(),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_TC89_L1)[-2:]
+    found = _size_filter(contours, params)
+    n = len(found)
+    if not n:
+        return []
+    boxes = [roi_box(cv2.boundingRect(cnt), gray.shape, params['roi_margin']) for cnt, L in found]
+
+# zones - the objects are numbered 1..n, 0 is outside of all zones
+    with profiling.stage("zones"):
+        seeds = np.full(gray.shape, 255, np.uint8)
+        cv2.drawContours(seeds, [cnt for cnt, L in found], -1, 0, -1)
+        dist, nearest = cv2.distanceTransformWithLabels(seeds, cv2.DIST_L2, 3, labelType=cv2.DIST_LABEL_CCOMP)
+        lut = np.zeros(int(nearest.max()) + 1, np.int32)
+        lut[[nearest[cnt[0,0,1], cnt[0,0,0]] for cnt, L in found]] = np.arange(1, n + 1)
+        zone = lut[nearest]
+        zone[dist > params['roi_margin']] = 0
+        del seeds, dist, nearest
+
+    with profiling.stage("roi_threshold"):
+        thresh = np.zeros(n + 1, np.uint8)
+        thresh[1:] = otsu_thresholds(label_histograms(gray, zone, n + 1)[1:])
+        binary = ((gray <= thresh[zone]) & (zone > 0)).view(np.uint8) * np.uint8(255)
+
+    with profiling.stage("roi_morphology"):
+        groups = {}
+        for idx, (cnt, L) in enumerate(found, 1):
+            groups.setdefault(roi_morphology(L, params), []).append(idx)
+        morph4 = np.zeros_like(binary)
+        for (k3, niter3, k4, niter4), members in groups.items():
+            x0 = min(boxes[i - 1][0] for i in members); y0 = min(boxes[i - 1][1] for i in members)
+            x1 = max(boxes[i - 1][2] for i in members); y1 = max(boxes[i - 1][3] for i in members)
+            member = np.zeros(n + 1, bool)
+            member[members] = True
+            inside = member[zone[y0:y1,x0:x1]]
+            sub = np.where(inside, binary[y0:y1,x0:x1], 0).astype(np.uint8)
+            kernel3 = morphology.structuring_element(cv2.MORPH_RECT,(k3,k3))
+            sub = cv2.morphologyEx(sub,cv2.MORPH_CLOSE,kernel3, iterations = niter3)
+            kernel4 = morphology.structuring_element(cv2.MORPH_CROSS,(k4,k4))
+            sub = cv2.morphologyEx(sub,cv2.MORPH_OPEN,kernel4, iterations = niter4)
+            np.copyto(morph4[y0:y1,x0:x1], sub, where=inside)
+        del binary
+
+# every component belongs to the zone most of its pixels are in, the largest
+# component of a zone is the object
+    with profiling.stage("roi_contours"):
+        n_comp, comp, stats, centroids = cv2.connectedComponentsWithStats(morph4, connectivity=8)
+        fg = comp > 0
+        overlap = np.bincount(comp[fg].astype(np.int64) * (n + 1) + zone[fg], minlength=n_comp * (n + 1))
+        owner = overlap.reshape(n_comp, n + 1).argmax(axis=1)
+        owner[0] = 0
+        area = stats[:, cv2.CC_STAT_AREA]
+        order = np.lexsort((-area, owner))
+        objs, first = np.unique(owner[order], return_index=True)
+        best = np.zeros(n + 1, np.int64)
+        best[objs] = order[first]
+        best[0] = 0
+        comp_obj = np.zeros(n_comp, np.int32)
+        comp_obj[best[best > 0]] = np.flatnonzero(best)
+        labels = comp_obj[comp]
+        del comp, fg, zone
+
+    with profiling.stage("roi_stats"):
+        mask = (labels > 0).view(np.uint8) * np.uint8(255)
+        inner = cv2.erode(mask,morphology.ones((5,5)),iterations = 1)
+        st = label_stats(gray, np.where(inner > 0, labels, 0), n + 1)
+        # outline pixels of all objects, grouped by object, for the enclosing circles
+        edge = mask > cv2.erode(mask,morphology.structuring_element(cv2.MORPH_CROSS,(3,3)),iterations = 1)
+        ys, xs = np.nonzero(edge)
+        edge_labels = labels[ys, xs]
+        order = np.argsort(edge_labels, kind='stable')
+        bounds = np.searchsorted(edge_labels[order], np.arange(n + 2))
+        points = np.stack([xs[order], ys[order]], axis=1).astype(np.int32)
+
+    records = []
+    for idx in range(1, n + 1):
+        c = best[idx]
+        if not c:
+            continue
+        box = boxes[idx - 1]
+        (cx,cy),radius = cv2.minEnclosingCircle(points[bounds[idx]:bounds[idx + 1]])
+        # outline for the control image, traced within the object's bounding box
+        sx, sy, sw, sh = stats[c, :4]
+        crop = (labels[sy:sy+sh, sx:sx+sw] == idx).view(np.uint8) * np.uint8(255)
+        shapes = cv2.findContours(crop,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_TC89_L1, offset=(int(sx - box[0]), int(sy - box[1])))[-2]
+        if st['count'][idx]:
+            stats_i = (float(st['mean'][idx]), float(st['sd'][idx]), int(st['min'][idx]), int(st['max'][idx]))
+        else:
+            stats_i = (np.nan,) * 4
+        rec = dict(
+            shape = max(shapes, key=cv2.contourArea),
+            circle = ((cx - box[0],cy - box[1]), radius),
+            centroid = (centroids[c][0] - box[0], centroids[c][1] - box[1]),
+            length = (int(radius) * 2)/params['scale'],
+            area = (float(area[c])/params['scale'])/params['scale'],
+            mean = stats_i[0],
+            sd = stats_i[1],
+            min = stats_i[2],
+            max = stats_i[3],
+            label = idx,
+            box = box,
+            )
+        rec['X'] = int(centroids[c][0])
+        rec['Y'] = int(centroids[c][1])
+        records.append(rec)
+    return records
+
+
+# =============================================================================
+# iii) create control image and text files that contain the results
+# =============================================================================
+
+def result_row(rec):
+    # one row of the results table (see COLUMNS), rounded like the original script
+    return [rec['label'], round(rec['X'],2), round(rec['Y'],2),
+            round(rec['length'],2), round(rec['area'],2),
+            round(rec['mean'],2), round(rec['sd'],2),
+            round(rec['min'],2), round(rec['max'],2)]
+
+
+def draw_control(img, gray, records):
+    """
+    draw ROI-box, contour, circle and label of every record into the
+    (BGR) scan to check if they are correct
+    """
+    for rec in records:
+        x0,y0,x1,y1 = rec['box']
+        (cx,cy),radius = rec['circle']
+        roi = cv2.cvtColor(gray[y0:y1,x0:x1], cv2.COLOR_GRAY2BGR)
+        roi = cv2.circle(roi,(int(cx),int(cy)),int(radius),(255,0,0),3)
+        roi = cv2.drawContours(roi, [rec['shape']], 0, (0,255,0), 3)
+        img[y0:y1,x0:x1] = roi
+        img = cv2.rectangle(img,(x0,y0),(x1,y1),(0,0, 255),3)
+        cv2.putText(img, str(rec['label']),(rec['X'],rec['Y']), cv2.FONT_HERSHEY_SIMPLEX, 2,(255,255,255),7,cv2.LINE_AA)
+    return img
+
+
+def draw_outlines(img, records, reduce=1):
+    """
+    draw ROI-box, contour, circle and label of every record into a scan
+    that was decoded at 1/reduce of its size (see process_scan)
+    """
+    f = 1.0 / reduce
+    thick = max(1, int(round(3 * f)))
+    for rec in records:
+        x0,y0,x1,y1 = rec['box']
+        (cx,cy),radius = rec['circle']
+        shape = np.round((rec['shape'] + (x0,y0)) * f).astype(np.int32)
+        img = cv2.circle(img,(int((cx + x0) * f),int((cy + y0) * f)),int(radius * f),(255,0,0),thick)
+        img = cv2.drawContours(img, [shape], 0, (0,255,0), thick)
+        img = cv2.rectangle(img,(int(x0 * f),int(y0 * f)),(int(x1 * f),int(y1 * f)),(0,0, 255),thick)
+        cv2.putText(img, str(rec['label']),(int(rec['X'] * f),int(rec['Y'] * f)), cv2.FONT_HERSHEY_SIMPLEX, 2 * f,(255,255,255),max(1, int(round(7 * f))),cv2.LINE_AA)
+    return img
+
+
+# decoding flags for control images at reduced size - jpeg scans are
+# decoded at that size directly
+_REDUCED = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def control_image(img, gray, records, scale=1):
+    """
+    control image of a scan at scale times its size (see control.py) - at
+    full size as drawn by draw_control, smaller ones with draw_outlines on
+    the reduced scan
+    """
+    if scale == 1:
+        return draw_control(img, gray, records)
+    return draw_outlines(resized(img, scale), records, 1.0 / scale)
+
+
+def control_image_file(path, decoded, gray, records, scale=1):
+    # control_image of a scan, decoded here unless it was decoded before (in decoded, see process_scan)
+    img = decoded[0] if decoded else _decode(path)
+    return control_image(img, gray, records, scale)
+
+
+def control_image_reduced(path, records, reduce, scale=1):
+    # control image of a scan in tiled mode, drawn on the scan decoded at 1/reduce of its size
+    img = resized(cv2.imread(path, _REDUCED[reduce]), scale)
+    return draw_outlines(img, records, reduce / scale)
+
+
+def _decode(path):
+    img = cv2.imread(path)
+    if img is None:
+        raise IOError("could not read image: " + path)
+    return img
+
+
+def _decode_gray(path, decoded):
+    # gray image of a scan - the decoded colour image is kept in decoded for the control image
+    decoded.append(_decode(path))
+    return cv2.cvtColor(decoded[0], cv2.COLOR_BGR2GRAY)
+
+
+def _write_results(path, rows):
+    with open(path, 'w') as res_file:
+        res_file.write('\t'.join(COLUMNS) + '\n')
+        for row in rows:
+            res_file.write('\t'.join(str(v) for v in row) + '\n')
+
+
+def process_scan(path, out_dir, params=None, cache_dir=None, cache_size=2 * 1024**3, band=None, control_reduce=4,
+                 control=None):
+    """
+    read one scan, analyse it and write "<name>.txt" and the control image
+    "<name>_output.jpg" to out_dir. returns the rows of the results file.
+    with cache_dir, the gray image and the detection result are cached.
+    control (a control.ControlWriter) decides if and how the control image
+    is written - default: at full size, before returning
+
+    with band (number of rows, e.g. 512), the scan is processed in tiled
+    mode (see tiles.py), for scans too large to hold in memory several
+    times: it is decoded straight to gray, and the control image is drawn
+    on the scan decoded at 1/control_reduce of its size (1, 2, 4 or 8).
+    the cache is not used in this mode
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    control = open_control(control)
+    if band:
+        with TiledScan(path, band) as scan:
+            records = analyse_scan_tiled(scan, params)
+        rows = [result_row(rec) for rec in records]
+        with profiling.stage("results"):
+            _write_results(os.path.join(out_dir, name + '.txt'), rows)
+        with profiling.stage("control_image"):
+            control.submit(os.path.join(out_dir, name + '_output.jpg'), control_image_reduced, path, records, control_reduce,
+                           flagged = control.flagged(records))
+        return rows
+
+    # the colour scan is only decoded if the gray image is not cached, or
+    # when the control image is drawn
+    cache = open_cache(cache_dir, cache_size)
+    decoded = []
+    with profiling.stage("gray"):
+        key, gray = cache.stage('gray', (cache.input_key(path),), _decode_gray, path, decoded)
+    records = analyse_scan(gray, params, cache = cache, key = key)
+    rows = [result_row(rec) for rec in records]
+
+    with profiling.stage("results"):
+        _write_results(os.path.join(out_dir, name + '.txt'), rows)
+
+    with profiling.stage("control_image"):
+        control.submit(os.path.join(out_dir, name + '_output.jpg'), control_image_file, path, decoded, gray, records,
+                       flagged = control.flagged(records))
+    return rows
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+parameter sweeps - evaluate many detection / recognition settings against
+reference measurements (e.g. the tables in examples/*/out) and find the
+fastest setting that stays within an accuracy tolerance.
+
+all (setting, image) combinations are spread over a process pool, ordered
+by image. the workers keep only the last few decoded images, so each image
+is decoded about once per worker while memory does not grow with the size
+of the dataset.
+
+    space = dict(det_val = [599, 799, 999], rec_it_open = [4, 6, 8])
+    report, best = sweep("camera", space, "examples/camera/gray",
+                         "examples/camera/reference.txt", tolerance = 0.05)
+
+the reference table must be checked by hand - the table the procedure
+wrote itself would only score the current setting against itself.
+"""
+
+import os
+import csv
+import time
+import random
+import itertools
+from functools import lru_cache
+import cv2
+import numpy as np
+
+from . import camera, scanner
+from .batch import run_batch
+
+
+# =============================================================================
+# search spaces
+# =============================================================================
+
+def grid(space):
+    # all combinations of the values in space (dict of name -> list of values)
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*[space[n] for n in names])]
+
+
+def random_configs(space, n, seed=None):
+    # n distinct random combinations of the values in space
+    configs = grid(space)
+    if n >= len(configs):
+        return configs
+    return random.Random(seed).sample(configs, n)
+
+
+# =============================================================================
+# reference data
+# =============================================================================
+
+def load_reference(path):
+    # rows of a results table (tab separated, with header) as list of dicts
+    with open(path, 'r', newline='') as f:
+        return list(csv.DictReader(f, delimiter='\t'))
+
+
+def _missing(value):
+    return value is None or value in ("", "NA")
+
+
+def _rel_error(value, ref):
+    # relative error of value, None if there is no reference value to score it against
+    if _missing(ref) or float(ref) == 0:
+        return None
+    if _missing(value):
+        return 1.0
+    return abs(float(value) - float(ref)) / float(ref)
+
+
+def _add(errors, value, ref):
+    err = _rel_error(value, ref)
+    if err is not None:
+        errors.append(err)
+
+
+def _find_image(image_dir, stem):
+    for f in sorted(os.listdir(image_dir)):
+        if os.path.splitext(f)[0] == stem:
+            return os.path.join(image_dir, f)
+    raise IOError("no image for " + stem + " in " + image_dir)
+
+
+def reference_tasks(kind, image_dir, reference_path):
+    """
+    list of (image path, reference rows) for a results table. camera tables
+    have one row per image (Source_file), scanner tables one row per object
+    of the image the table is named after
+    """
+    rows = load_reference(reference_path)
+    if kind == "camera":
+        return [(os.path.join(image_dir, row['Source_file']), [row]) for row in rows]
+    stem = os.path.splitext(os.path.basename(reference_path))[0]
+    return [(_find_image(image_dir, stem), rows)]
+
+
+# =============================================================================
+# evaluation (in the workers)
+# =============================================================================
+
+@lru_cache(maxsize=2)
+def _load(kind, path):
+    # the last decoded images of a worker - jobs come ordered by image (see evaluate_configs)
+    if kind == "camera":
+        return cv2.imread(path, 0)
+    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+
+
+def _errors_camera(img, config, ref_rows):
+    roi, rec = camera.analyse_gray(img, config)
+    ref = ref_rows[0]
+    length_err, area_err = [], []
+    _add(length_err, rec and rec['length'], ref['Length'])
+    _add(area_err, rec and rec['area'], ref['Area'])
+    return length_err, area_err
+
+
+def _errors_scanner(img, config, ref_rows, max_dist=50):
+    # every reference object is matched to the closest detected centroid
+    records = scanner.analyse_scan(img, config)
+    xy = np.array([[r['X'], r['Y']] for r in records], dtype=float).reshape(-1, 2)
+    length_err, area_err = [], []
+    for ref in ref_rows:
+        if len(xy):
+            d = np.hypot(xy[:,0] - float(ref['X']), xy[:,1] - float(ref['Y']))
+            j = int(np.argmin(d))
+        if not len(xy) or d[j] > max_dist:
+            length_err.append(1.0)
+            area_err.append(1.0)
+            continue
+        _add(length_err, records[j]['length'], ref['Length'])
+        _add(area_err, records[j]['area'], ref['Area'])
+    return length_err, area_err
+
+
+def _evaluate(task, kind):
+    idx, config, path, ref_rows = task
+    img = _load(kind, path)
+    start = time.perf_counter()
+    if kind == "camera":
+        length_err, area_err = _errors_camera(img, config, ref_rows)
+    else:
+        length_err, area_err = _errors_scanner(img, config, ref_rows)
+    return idx, time.perf_counter() - start, length_err, area_err
+
+
+# =============================================================================
+# sweep
+# =============================================================================
+
+def _mean(errors):
+    # nan if no reference value could be scored
+    return float(np.mean(errors)) if errors else float('nan')
+
+
+def evaluate_configs(kind, configs, tasks, n_workers=None):
+    """
+    run every config on every (image, reference rows) task. returns one
+    report entry per config: total analysis time, mean and max relative
+    error of length and area, and the number of failed images
+    """
+    jobs = [(idx, config, path, rows) for path, rows in tasks for idx, config in enumerate(configs)]
+    stats = [dict(config = config, seconds = 0.0, length_err = [], area_err = [], failed = 0) for config in configs]
+    for res in run_batch(_evaluate, jobs, n_workers = n_workers, args = (kind,)):
+        if res.error:
+            entry = stats[res.item[0]]
+            entry['failed'] += 1
+            entry['length_err'].extend([1.0] * len(res.item[3]))
+            entry['area_err'].extend([1.0] * len(res.item[3]))
+            continue
+        idx, seconds, length_err, area_err = res.value
+        stats[idx]['seconds'] += seconds
+        stats[idx]['length_err'].extend(length_err)
+        stats[idx]['area_err'].extend(area_err)
+
+    report = []
+    for entry in stats:
+        errors = entry['length_err'] + entry['area_err']
+        report.append(dict(
+            config = entry['config'],
+            seconds = entry['seconds'],
+            length_err = _mean(entry['length_err']),
+            area_err = _mean(entry['area_err']),
+            max_err = float(np.max(errors)) if errors else float('nan'),
+            failed = entry['failed'],
+            ))
+    return sorted(report, key=lambda r: r['seconds'])
+
+
+def sweep(kind, space, image_dir, reference_path, tolerance=0.05, search="grid",
+          n=20, seed=None, base_params=None, n_workers=None):
+    """
+    evaluate a search space (dict of parameter name -> list of values) for
+    the "camera" or "scanner" procedure. search is "grid" (all combinations)
+    or "random" (n random combinations). base_params are the fixed
+    parameters the search space is applied on.
+
+    returns (report, best): the report has one entry per setting, sorted by
+    time; best is the fastest setting whose mean length and area errors are
+    both within tolerance (None if there is none)
+    """
+    if search == "grid":
+        configs = grid(space)
+    elif search == "random":
+        configs = random_configs(space, n, seed)
+    else:
+        raise ValueError("unknown search: " + search)
+    configs = [dict(base_params or {}, **c) for c in configs]
+
+    tasks = reference_tasks(kind, image_dir, reference_path)
+    report = evaluate_configs(kind, configs, tasks, n_workers)
+    within = [r for r in report if not r['failed'] and r['length_err'] <= tolerance and r['area_err'] <= tolerance]
+    return report, (within[0] if within else None)
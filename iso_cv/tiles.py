@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+tiled processing of large scans - the scan is decoded straight to gray (no
+BGR copy), kept in a file on disk and processed in horizontal bands of rows.
+decoding still needs the whole gray image in memory once (a third of the
+BGR image, opencv can't decode a jpeg in strips), but it is released before
+processing starts - from then on the memory needed depends on the band
+size, not on the size of the scan.
+
+detection gives the same objects as scanner.detect and find_objects on the
+whole image: the threshold is Otsu's on the histogram of all bands, every
+band is processed with enough extra rows (halo) for the morphology to be
+exact at its borders, and objects that cross band borders are joined by
+their connected component labels along the seams. the contour of an object
+is traced on its bounding box only, and ROIs are cut from the gray image on
+disk when they are measured.
+"""
+
+import os
+import tempfile
+import cv2
+import numpy as np
+
+from . import morphology, profiling
+
+
+def otsu_threshold(hist):
+    """
+    Otsu's threshold of a 256-bin histogram - the same value cv2.threshold
+    finds with THRESH_OTSU on the image the histogram was taken from
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    total = hist.sum()
+    if not total:
+        return 0.0
+    scale = 1.0 / total
+    mu = float(np.dot(np.arange(len(hist)), hist)) * scale
+    eps = np.finfo(np.float32).eps
+    q1 = mu1 = max_sigma = max_val = 0.0
+    # same steps (and rounding) as opencv
+    for i in range(len(hist)):
+        p_i = hist[i] * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < eps or max(q1, q2) > 1.0 - eps:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu2 - mu1) * (mu2 - mu1)
+        if sigma > max_sigma:
+            max_sigma, max_val = sigma, i
+    return float(max_val)
+
+
+def detection_halo(params):
+    # rows a pixel of the detection result depends on, above and below it
+    reach_close = max(params['det_kern_close']) // 2 * max(params['det_it_close'], 1)
+    reach_open = max(params['det_kern_open']) // 2 * max(params['det_it_open'], 1)
+    return 2 * (reach_close + reach_open)
+
+
+def _seam_pairs(above, below):
+    # pairs of labels that touch across a band border (8-connectivity)
+    w = len(above)
+    pairs = []
+    for s in (-1, 0, 1):
+        a = above[max(0, s):w + min(0, s)]
+        b = below[max(0, -s):w + min(0, -s)]
+        both = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[both], b[both]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+class TiledScan(object):
+    """
+    a scan decoded to gray and stored in work_dir (default: the temporary
+    directory), processed in bands of band rows. the gray image is only
+    held in memory while it is decoded and saved. use as a context manager,
+    or call close, to remove the files
+    """
+
+    def __init__(self, path, band=512, work_dir=None):
+        self.path = path
+        self.band = band
+        self._tmp = tempfile.TemporaryDirectory(prefix="iso_cv_tiles_", dir=work_dir)
+        with profiling.stage("decode"):
+            gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            self.close()
+            raise IOError("could not read image: " + path)
+        self.shape = gray.shape
+        gray_path = os.path.join(self._tmp.name, "gray.npy")
+        np.save(gray_path, gray)
+        del gray
+        self.gray = np.load(gray_path, mmap_mode='r')
+        self.morph = None
+
+    def bands(self, halo=0):
+        # (y0, y1, h0, h1) per band: rows y0:y1, read with halo as rows h0:h1
+        height = self.shape[0]
+        for y0 in range(0, height, self.band):
+            y1 = min(height, y0 + self.band)
+            yield y0, y1, max(0, y0 - halo), min(height, y1 + halo)
+
+    def histogram(self):
+        # gray value histogram of the whole scan, accumulated band by band
+        hist = np.zeros(256, np.float64)
+        for y0, y1, h0, h1 in self.bands():
+            hist += cv2.calcHist([np.ascontiguousarray(self.gray[y0:y1])],[0],None,[256],[0,256]).ravel()
+        return hist
+
+    def detect(self, params):
+        """
+        threshold and morphology of scanner.detect, band by band, into a
+        binary image on disk (self.morph). returns the bounding boxes
+        (x0, y0, x1, y1) of all objects
+        """
+        with profiling.stage("histogram"):
+            thresh_val = otsu_threshold(self.histogram())
+        kernel1 = morphology.structuring_element(cv2.MORPH_RECT,params['det_kern_close'])
+        kernel2 = morphology.structuring_element(cv2.MORPH_CROSS,params['det_kern_open'])
+        halo = detection_halo(params)
+
+        self.morph = np.lib.format.open_memmap(os.path.join(self._tmp.name, "morph.npy"),
+                                               mode='w+', dtype=np.uint8, shape=self.shape)
+        parent, boxes = [], []
+        last_row, a_offset = None, 0
+        for y0, y1, h0, h1 in self.bands(halo):
+            with profiling.stage("threshold"):
+                ret, thresh = cv2.threshold(np.ascontiguousarray(self.gray[h0:h1]),thresh_val,255,cv2.THRESH_BINARY_INV)
+            with profiling.stage("morphology"):
+                morph1 = cv2.morphologyEx(thresh,cv2.MORPH_CLOSE,kernel1, iterations = params['det_it_close'])
+                morph2 = cv2.morphologyEx(morph1,cv2.MORPH_OPEN,kernel2, iterations = params['det_it_open'])
+                core = morph2[y0 - h0:y1 - h0]
+                self.morph[y0:y1] = core
+                self.morph.flush()
+
+            # label the objects of the band and join them with those of the
+            # band above where they touch
+            with profiling.stage("labels"):
+                n, labels, stats, centroids = cv2.connectedComponentsWithStats(core, connectivity=8)
+                offset = len(parent) - 1
+                for x, y, w, h, area in stats[1:]:
+                    parent.append(len(parent))
+                    boxes.append([x, y + y0, x + w, y + y0 + h, area])
+                if last_row is not None:
+                    for a, b in _seam_pairs(last_row, labels[0]):
+                        _union(parent, a_offset + int(a), offset + int(b))
+                last_row, a_offset = labels[-1].copy(), offset
+
+        merged = {}
+        for i, box in enumerate(boxes):
+            root = _find(parent, i)
+            if root in merged:
+                m = merged[root]
+                m[0], m[1] = min(m[0], box[0]), min(m[1], box[1])
+                m[2], m[3] = max(m[2], box[2]), max(m[3], box[3])
+                m[4] += box[4]
+            else:
+                merged[root] = list(box)
+        # an outline of more than 50 points (see scanner.find_objects) needs more pixels than that
+        return [tuple(int(v) for v in m[:4]) for m in merged.values() if m[4] > 50]
+
+    def contour(self, box):
+        """
+        outer contour (in scan coordinates) of the object with bounding box
+        box, traced on the binary image within the box only
+        """
+        x0, y0, x1, y1 = box
+        crop = np.ascontiguousarray(self.morph[y0:y1, x0:x1])
+        contours, hierarchy = cv2.findContours(crop,cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_TC89_L1, offset=(x0, y0))[-2:]
+        # other objects may reach into the box - the object is the one that fills it
+        rect = (x0, y0, x1 - x0, y1 - y0)
+        own = [cnt for cnt in contours if cv2.boundingRect(cnt) == rect] or contours
+        return max(own, key=cv2.contourArea)
+
+    def crop(self, box):
+        # gray image within box (x0, y0, x1, y1), read from disk
+        x0, y0, x1, y1 = box
+        return np.array(self.gray[y0:y1, x0:x1])
+
+    def close(self):
+        self.gray = self.morph = None
+        self._tmp.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _find(parent, i):
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        parent[i], i = root, parent[i]
+    return root
+
+
+def _union(parent, a, b):
+    ra, rb = _find(parent, a), _find(parent, b)
+    if ra != rb:
+        parent[max(ra, rb)] = min(ra, rb)
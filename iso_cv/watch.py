@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+ingest mode - watches an input directory for new images (e.g. dropped there
+by cameras during a live experiment) and processes each one as soon as it
+has been completely written.
+
+the watcher only looks into directories whose modification time changed
+(or gets file events from watchdog, if installed), so the cost of a check
+does not grow with the number of images already in the directory. images
+flow through the processing stages in threads connected by bounded queues:
+when processing falls behind, the queues fill up and the watcher stops
+taking new files until there is room again (backpressure), instead of
+piling up decoded images in memory.
+"""
+
+import os
+import time
+import queue
+import threading
+import traceback
+from collections import namedtuple
+
+import cv2
+
+from . import camera
+from .control import ControlWriter
+from .manifest import Manifest
+from .metadata import IMAGE_EXTENSIONS
+from .results import open_sink
+
+# one result per item. "latency" is the time in seconds from entering the
+# pipeline to leaving it
+PipelineResult = namedtuple("PipelineResult", ["item", "value", "error", "latency"])
+
+
+# bytes that end a complete file, per extension. a jpeg ends with the EOI
+# marker, which can only be followed by some padding
+_TRAILERS = {
+    '.jpg': b'\xff\xd9', '.jpeg': b'\xff\xd9',
+    '.png': b'IEND\xaeB`\x82',
+    }
+
+
+def file_complete(path, tail=64):
+    """
+    True if a file looks completely written: jpeg and png files have to end
+    with their end marker (within the last tail bytes), other formats are
+    not checked
+    """
+    trailer = _TRAILERS.get(os.path.splitext(path)[1].lower())
+    if trailer is None:
+        return True
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - tail))
+            return trailer in f.read()
+    except OSError:
+        return False
+
+
+class DirectoryWatcher(object):
+    """
+    reports files in directory (and its subdirectories, if recursive) once
+    they are complete. a file counts as complete when its size and mtime
+    are the same on two checks at least settle seconds apart, and complete
+    (default: file_complete) accepts it - partially written files are held
+    back, also when the writer stalls for longer than settle. with existing
+    = False, files that are already there at the start are ignored.
+
+    backend "poll" lists only directories whose mtime changed since the last
+    check, "watchdog" uses file system events (inotify etc.) through the
+    watchdog package, "auto" takes watchdog if it is installed. in both
+    cases the whole tree is listed again every rescan seconds, as a safety
+    net for missed events and coarse directory timestamps
+    """
+
+    def __init__(self, directory, extensions=IMAGE_EXTENSIONS, recursive=True, interval=0.1,
+                 settle=0.3, rescan=60.0, existing=True, backend="auto", complete=None):
+        self.directory = os.path.abspath(directory)
+        self.extensions = tuple(e.lower() for e in extensions)
+        self.recursive = recursive
+        self.interval = interval
+        self.settle = settle
+        self.complete = complete or file_complete
+        self.rescan = rescan
+        self._seen = set() # reported files
+        self._pending = {} # files waiting to be complete: path -> ((size, mtime), time first seen like this)
+        self._dirs = {} # directory -> (mtime, subdirectories)
+        self._last_scan = time.monotonic()
+        self._observer = None
+        if backend == "auto":
+            try:
+                import watchdog
+                backend = "watchdog"
+            except ImportError:
+                backend = "poll"
+        if backend == "watchdog":
+            self._start_observer()
+        elif backend != "poll":
+            raise ValueError("unknown backend: " + str(backend))
+        self.backend = backend
+
+        found = self._list(self.directory, True)
+        if existing:
+            for path in found:
+                self._pending[path] = None
+        else:
+            self._seen.update(found)
+
+    def _wanted(self, path):
+        return path.lower().endswith(self.extensions) and path not in self._seen
+
+    def _start_observer(self):
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+
+        self._events = set()
+        self._events_lock = threading.Lock()
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory:
+                    return
+                path = getattr(event, 'dest_path', None) or event.src_path
+                with watcher._events_lock:
+                    watcher._events.add(os.path.abspath(path))
+
+        self._observer = Observer()
+        self._observer.schedule(Handler(), self.directory, recursive=self.recursive)
+        self._observer.start()
+
+    def _list(self, directory, full=False):
+        """
+        new files in directory. unless full, directories whose mtime is
+        unchanged are not listed again. mtimes that are younger than settle
+        are not remembered, so files that arrive within the timestamp
+        resolution of the file system are still found on the next check
+        """
+        found = []
+        dirs = [directory]
+        now = time.time()
+        while dirs:
+            d = dirs.pop()
+            try:
+                mtime = os.stat(d).st_mtime_ns
+            except OSError:
+                self._dirs.pop(d, None)
+                continue
+            known = self._dirs.get(d)
+            if not full and known and known[0] == mtime:
+                dirs.extend(known[1])
+                continue
+            subdirs = []
+            try:
+                with os.scandir(d) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.path)
+                        elif self._wanted(entry.path):
+                            found.append(entry.path)
+            except OSError:
+                continue
+            if not self.recursive:
+                subdirs = []
+            self._dirs[d] = (mtime if now - mtime / 1e9 > self.settle else None, subdirs)
+            dirs.extend(subdirs)
+        return found
+
+    def _candidates(self, full):
+        if self._observer is None or full:
+            return self._list(self.directory, full)
+        with self._events_lock:
+            events, self._events = self._events, set()
+        return [p for p in events if self._wanted(p)]
+
+    def poll(self):
+        """
+        files that have become complete since the last call, sorted
+        """
+        now = time.monotonic()
+        full = bool(self.rescan) and now - self._last_scan >= self.rescan
+        if full:
+            self._last_scan = now
+        for path in self._candidates(full):
+            self._pending.setdefault(path, None)
+
+        ready = []
+        for path, last in list(self._pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError: # removed or renamed in the meantime
+                del self._pending[path]
+                continue
+            sig = (st.st_size, st.st_mtime_ns)
+            if not st.st_size:
+                self._pending[path] = None
+            elif not last or last[0] != sig:
+                self._pending[path] = (sig, now)
+            elif now - last[1] >= self.settle:
+                if self.complete(path):
+                    del self._pending[path]
+                    self._seen.add(path)
+                    ready.append(path)
+                else: # the writer stalled - wait for the file to change again
+                    self._pending[path] = (sig, now)
+        return sorted(ready)
+
+    def watch(self, stop=None):
+        """
+        yield complete files as they arrive, until stop (a threading.Event)
+        is set
+        """
+        try:
+            while not (stop and stop.is_set()):
+                for path in self.poll():
+                    yield path
+                if stop:
+                    stop.wait(self.interval)
+                else:
+                    time.sleep(self.interval)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+
+# =============================================================================
+# pipeline
+# =============================================================================
+
+_END = object()
+
+
+def _stage_worker(func, q_in, q_out, n_out, state, lock):
+    # runs func on the value of every item; items that failed before are
+    # passed on unchanged. the last thread of a stage to finish tells the
+    # next stage to finish as well
+    while True:
+        entry = q_in.get()
+        if entry is _END:
+            break
+        item, value, error, start = entry
+        if error is None:
+            try:
+                value = func(value)
+            except Exception:
+                value, error = None, traceback.format_exc()
+        q_out.put((item, value, error, start))
+    with lock:
+        state['running'] -= 1
+        last = state['running'] == 0
+    if last:
+        for i in range(n_out):
+            q_out.put(_END)
+
+
+def run_pipeline(source, stages, maxsize=4, stop=None):
+    """
+    pass every item of source through stages - a list of functions, or of
+    (function, number of threads) - each taking the return value of the
+    previous one (the first gets the item). all stages run at the same time
+    in their own threads (opencv releases the GIL), connected by queues of
+    maxsize items. yields a PipelineResult per item, in the order they are
+    finished. a failing item does not stop the others.
+
+    source is read in a thread of its own. the pipeline stops when source is
+    exhausted or stop (a threading.Event) is set - items already in the
+    pipeline are still finished and yielded. when the generator is closed,
+    stop is set and the remaining items are run out without being yielded
+    (source must then come to an end, like DirectoryWatcher.watch(stop))
+    """
+    stop = stop or threading.Event()
+    stages = [s if isinstance(s, tuple) else (s, 1) for s in stages]
+    queues = [queue.Queue(maxsize) for s in stages] + [queue.Queue(maxsize)]
+    threads = []
+
+    def feed():
+        try:
+            for item in source:
+                if stop.is_set():
+                    break
+                queues[0].put((item, item, None, time.perf_counter()))
+                if stop.is_set():
+                    break
+        finally:
+            for i in range(stages[0][1]):
+                queues[0].put(_END)
+
+    threads.append(threading.Thread(target=feed, daemon=True))
+    for idx, (func, n_threads) in enumerate(stages):
+        n_out = stages[idx + 1][1] if idx + 1 < len(stages) else 1
+        state, lock = dict(running = n_threads), threading.Lock()
+        for i in range(n_threads):
+            threads.append(threading.Thread(target=_stage_worker, daemon=True,
+                                            args=(func, queues[idx], queues[idx + 1], n_out, state, lock)))
+    for t in threads:
+        t.start()
+
+    finished = False
+    try:
+        while True:
+            entry = queues[-1].get()
+            if entry is _END:
+                finished = True
+                break
+            item, value, error, start = entry
+            yield PipelineResult(item, value, error, time.perf_counter() - start)
+    finally:
+        # let the remaining items run out, so no thread stays blocked on a
+        # full queue
+        stop.set()
+        if not finished:
+            for entry in iter(queues[-1].get, _END):
+                pass
+
+
+# =============================================================================
+# camera ingest
+# =============================================================================
+
+def ingest_camera(in_dir, gray_dir, out_dir, res_path, params=None, ref=240, resize=0.5,
+                  n_threads=2, maxsize=4, stop=None, manifest=None, control=None, **watch_kw):
+    """
+    live version of iso-cv-camera.py: every new image in in_dir is
+    normalized (saved to gray_dir), analysed and its control image saved to
+    out_dir, and its row written to the results table at res_path (see
+    results.open_sink) right away. finished images are recorded in a
+    manifest (out_dir/gray_manifest.json by default), so images that were
+    processed before - in an earlier ingest or batch run - are skipped.
+
+    n_threads threads each normalize and analyse images, maxsize is the
+    length of the queues between them. runs until stop (a threading.Event)
+    is set or the generator is closed (e.g. KeyboardInterrupt). yields a
+    PipelineResult per image; its value is the name of the gray image.
+    control (a control.ControlWriter, default: all at full size) writes the
+    control images in the background. further keyword arguments go to
+    DirectoryWatcher
+    """
+    params = camera.get_params(params)
+    stop = stop or threading.Event() # the watcher and the pipeline must see the same one
+    manifest = manifest or Manifest(os.path.join(out_dir, "gray_manifest.json"), output_dir = gray_dir)
+    lock = threading.Lock() # the manifest is checked in the workers and updated here
+    writer = control or ControlWriter()
+    watcher = DirectoryWatcher(in_dir, **watch_kw)
+
+    def normalize(path):
+        with lock:
+            key = manifest.key(path)
+            done = manifest.is_done(path, key)
+        if done:
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        name, img = camera.normalize_data(data, path, ref, resize)
+        cv2.imwrite(os.path.join(gray_dir, name), img)
+        return key, name, img
+
+    def analyse(job):
+        if job is None:
+            return None
+        key, name, img = job
+        roi, rec = camera.analyse_gray(img, params)
+        writer.submit(os.path.join(out_dir, name), camera.control_image, roi, rec,
+                      flagged = rec is None or writer.flagged(rec))
+        return key, name, rec
+
+    results = open_sink(res_path, camera.COLUMNS, key = "Source_file")
+    stages = [(normalize, n_threads), (analyse, n_threads)]
+    try:
+        for res in run_pipeline(watcher.watch(stop), stages, maxsize, stop):
+            if res.error is None:
+                if res.value is None:
+                    continue # done before
+                key, name, rec = res.value
+                if rec:
+                    results.write(camera.result_row(name, rec, params))
+                with lock:
+                    manifest.mark_done(res.item, name, key)
+                res = res._replace(value = name)
+            yield res
+    finally:
+        if control is None:
+            writer.close()
+        else:
+            writer.flush()
+        results.close()
+        with lock:
+            manifest.save()
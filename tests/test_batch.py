@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+batch engine (iso_cv/batch.py) and process_many - the finalizer runs once
+in every worker, and control images that fail in the workers end up in the
+errors of the main writer, also those still pending after the last item
+"""
+
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from iso_cv.batch import FINAL, run_batch
+from iso_cv.control import ControlWriter
+from iso_cv.pipeline import ScannerPipeline
+
+
+def square(x):
+    return x * x
+
+
+@pytest.mark.parametrize("n_workers", [1, 3])
+def test_finalizer_once_per_worker(n_workers):
+    results = list(run_batch(square, range(20), n_workers = n_workers, finalizer = os.getpid))
+    assert [r.value for r in results[:20]] == [x * x for x in range(20)]
+    final = results[20:]
+    assert len(final) == n_workers
+    assert all(r.item is FINAL and r.error is None for r in final)
+    assert len(set(r.value for r in final)) == n_workers
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_worker_control_errors(tmp_path, n_workers):
+    # the control directory does not exist, so every control image fails
+    paths = []
+    for i in range(6):
+        paths.append(str(tmp_path / ("scan_%d.jpg" % i)))
+        cv2.imwrite(paths[-1], np.full((120, 160, 3), 200, np.uint8))
+    control = ControlWriter("full")
+    pipe = ScannerPipeline()
+    results = list(pipe.process_many(paths, n_workers = n_workers, control_dir = str(tmp_path / "missing"), control = control))
+    control.close()
+    assert [r.item for r in results] == paths
+    assert all(r.error is None and r.value == [] for r in results)
+    assert sorted(os.path.basename(p) for p, error in control.errors) == ["scan_%d_output.jpg" % i for i in range(6)]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+StageCache (iso_cv/cache.py) shared by several processes - the size limit
+holds for all of them together, and files removed by another process
+don't fail a stage
+"""
+
+import os
+
+import numpy as np
+
+from iso_cv.cache import StageCache, make_key
+
+
+def disk_size(root):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, dirs, files in os.walk(root) for f in files)
+
+
+def test_size_limit_shared(tmp_path):
+    # four "workers" (one StageCache each) fill the same directory
+    arr = np.zeros((100, 100), np.uint8)
+    root = str(tmp_path / "cache")
+    StageCache(root).put(make_key("probe"), arr)
+    one = disk_size(root) # size of one file
+    max_bytes = 20 * one
+    workers = [StageCache(root, max_bytes, check_every = 4) for i in range(4)]
+    for i in range(200):
+        workers[i % 4].put(make_key("stage", i), arr)
+        # at most check_every files per worker since its last check
+        assert disk_size(root) <= max_bytes + 4 * 4 * one
+
+
+def test_files_removed_by_another_process(tmp_path):
+    root = str(tmp_path / "cache")
+    a, b = StageCache(root, check_every = 1), StageCache(root)
+    key, arr = a.stage("gray", (), np.ones, (50, 50))
+    assert a.get(key) is not None
+    b.clear()
+    assert a.get(key) is None
+    key, arr = a.stage("gray", (), np.ones, (50, 50))
+    assert np.array_equal(a.get(key), np.ones((50, 50)))
+    # a file listed by evict is gone when it is removed
+    files = list(a._files())
+    b.clear()
+    a.evict(target = 0, files = files)
+    a.check()
+    assert a._size == 0
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+the kernels of iso_cv/morphology.py are built once and shared by all
+callers, so they must not be writable
+"""
+
+import cv2
+import pytest
+
+from iso_cv import morphology
+
+
+def test_kernels_shared_and_read_only():
+    assert morphology.ones([5,5]) is morphology.ones((5,5))
+    kernel = morphology.structuring_element(cv2.MORPH_CROSS, (9,9))
+    assert kernel is morphology.structuring_element(cv2.MORPH_CROSS, [9,9])
+    with pytest.raises(ValueError):
+        kernel[0, 0] = 1
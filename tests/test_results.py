@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+result sinks (iso_cv/results.py) - upserts, replacing all rows of a scan,
+compaction of text files and recovery from the parquet journal. every
+table is read back from disk by a new sink
+"""
+
+import os
+import sqlite3
+
+import pytest
+
+from iso_cv.results import open_sink, SqliteSink, TextSink
+
+COLUMNS = ["Source_file", "PyLabel", "Length"]
+KEY = ("Source_file", "PyLabel")
+
+
+def rows(sink):
+    # the rows a sink holds, as strings and sorted
+    if isinstance(sink, SqliteSink):
+        found = sink.con.execute('SELECT * FROM "results"').fetchall()
+    else:
+        sink._pack()
+        found = sink._rows
+    return sorted([str(v) for v in row] for row in found)
+
+
+def table(path):
+    # the rows of the file at path, read by a new sink
+    if path.endswith(".sqlite"):
+        with sqlite3.connect(path) as con:
+            return sorted([str(v) for v in row] for row in con.execute('SELECT * FROM "results"'))
+    sink = open_sink(path, COLUMNS, key = KEY)
+    return rows(sink)
+
+
+def scan(name, n, length=1.0):
+    return [[name, i + 1, length * (i + 1)] for i in range(n)]
+
+
+def expected(*scans):
+    return sorted([str(v) for v in row] for s in scans for row in s)
+
+
+FORMATS = [".txt", ".csv", ".sqlite", ".parquet"]
+
+
+@pytest.fixture(params=FORMATS)
+def path(request, tmp_path):
+    if request.param == ".parquet":
+        pytest.importorskip("pandas")
+        pytest.importorskip("pyarrow")
+    return str(tmp_path / ("all" + request.param))
+
+
+def test_upsert(path):
+    with open_sink(path, COLUMNS, key = KEY) as sink:
+        sink.write_many(scan("a.jpg", 3))
+        sink.write(["a.jpg", 2, 5.0])
+        sink.write_many(scan("b.jpg", 1))
+    assert table(path) == expected([["a.jpg", 1, 1.0], ["a.jpg", 2, 5.0], ["a.jpg", 3, 3.0]], scan("b.jpg", 1))
+    # a second run replaces rows of the first
+    with open_sink(path, COLUMNS, key = KEY) as sink:
+        sink.write(["a.jpg", 2, 2.0])
+    assert table(path) == expected(scan("a.jpg", 3), scan("b.jpg", 1))
+
+
+@pytest.mark.parametrize("flush_every", [1, 5, None])
+def test_replace_group_with_fewer_rows(path, flush_every):
+    with open_sink(path, COLUMNS, key = KEY, flush_every = flush_every) as sink:
+        sink.replace_group("a.jpg", scan("a.jpg", 4))
+        sink.replace_group("b.jpg", scan("b.jpg", 2))
+    assert table(path) == expected(scan("a.jpg", 4), scan("b.jpg", 2))
+    # the scan is processed again and now has 3 objects, later none
+    with open_sink(path, COLUMNS, key = KEY, flush_every = flush_every) as sink:
+        sink.write_many(scan("c.jpg", 1))
+        sink.replace_group("a.jpg", scan("a.jpg", 3, 2.0))
+        assert rows(sink) == expected(scan("a.jpg", 3, 2.0), scan("b.jpg", 2), scan("c.jpg", 1))
+    assert table(path) == expected(scan("a.jpg", 3, 2.0), scan("b.jpg", 2), scan("c.jpg", 1))
+    with open_sink(path, COLUMNS, key = KEY, flush_every = flush_every) as sink:
+        sink.replace_group("b.jpg", [])
+    assert table(path) == expected(scan("a.jpg", 3, 2.0), scan("c.jpg", 1))
+
+
+def test_replace_group_text_on_disk(tmp_path):
+    # removed rows are gone from the file right away, not only on close
+    path = str(tmp_path / "all.txt")
+    sink = TextSink(path, COLUMNS, key = KEY)
+    sink.replace_group("a.jpg", scan("a.jpg", 4))
+    sink.replace_group("a.jpg", scan("a.jpg", 3))
+    assert table(path) == expected(scan("a.jpg", 3))
+    # with as many rows as before, the file is only appended to
+    size = os.path.getsize(path)
+    sink.replace_group("a.jpg", scan("a.jpg", 3, 2.0))
+    assert os.path.getsize(path) > size
+    assert table(path) == expected(scan("a.jpg", 3, 2.0))
+    sink.close()
+
+
+def test_replace_group_needs_key(tmp_path):
+    with open_sink(str(tmp_path / "all.txt"), COLUMNS) as sink:
+        with pytest.raises(ValueError):
+            sink.replace_group("a.jpg", scan("a.jpg", 1))
+
+
+def test_text_compaction(tmp_path):
+    # replaced rows are appended, and dropped when they outnumber the others
+    path = str(tmp_path / "all.txt")
+    sink = TextSink(path, COLUMNS, key = KEY)
+    sink.write_many(scan("a.jpg", 2))
+    for i in range(5):
+        sink.write(["a.jpg", 1, float(i)])
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) < 1 + 2 + 5
+    assert table(path) == expected([["a.jpg", 1, 4.0], ["a.jpg", 2, 2.0]])
+    sink.close()
+    with open(path) as f:
+        assert len(f.read().splitlines()) == 3
+
+
+def test_text_without_key_appends(tmp_path):
+    path = str(tmp_path / "all.csv")
+    with open_sink(path, COLUMNS) as sink:
+        sink.write_many(scan("a.jpg", 2))
+    with open_sink(path, COLUMNS) as sink:
+        sink.write_many(scan("a.jpg", 2))
+    with open(path) as f:
+        assert len(f.read().splitlines()) == 5
+
+
+def test_text_wrong_columns(tmp_path):
+    path = str(tmp_path / "all.txt")
+    with open_sink(path, COLUMNS, key = KEY) as sink:
+        sink.write(scan("a.jpg", 1)[0])
+    with pytest.raises(ValueError):
+        open_sink(path, COLUMNS[:2], key = KEY)
+
+
+def test_journal_recovery(tmp_path):
+    # a run that stopped before closing the sink is read back from the journal
+    pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "all.parquet")
+    with open_sink(path, COLUMNS, key = KEY) as sink:
+        sink.replace_group("a.jpg", scan("a.jpg", 4))
+        sink.replace_group("b.jpg", scan("b.jpg", 1))
+    sink = open_sink(path, COLUMNS, key = KEY)
+    sink.replace_group("a.jpg", scan("a.jpg", 2, 2.0))
+    sink.write(["c.jpg", 1, 1.0])
+    with open(sink.journal, 'a') as f:
+        f.write('["c.jpg", 2') # killed while writing a row
+    del sink
+    assert table(path) == expected(scan("a.jpg", 2, 2.0), scan("b.jpg", 1), scan("c.jpg", 1))
+    open_sink(path, COLUMNS, key = KEY).close()
+    assert not os.path.isfile(path + ".journal")
+    assert table(path) == expected(scan("a.jpg", 2, 2.0), scan("b.jpg", 1), scan("c.jpg", 1))
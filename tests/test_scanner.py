@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+the two measurement engines of the scanner (iso_cv/scanner.py) find the
+same objects with about the same measurements, and the batched Otsu
+thresholds of the label engine are those of cv2.threshold
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from iso_cv import scanner
+from iso_cv.measure import label_histograms, otsu_thresholds
+
+
+def make_scan(seed=0):
+    # dark ellipses (length 200 - 500 px) on a light, noisy background
+    rng = np.random.RandomState(seed)
+    img = np.full((1500, 2000), 215, np.uint8)
+    for i, (x, y) in enumerate([(300, 300), (1000, 350), (1650, 400), (400, 1100), (1100, 1150), (1700, 1150)]):
+        length = rng.randint(200, 500)
+        cv2.ellipse(img, (x, y), (length // 2, int(length * 0.2)), float(rng.randint(0, 180)), 0, 360,
+                    int(rng.randint(50, 110)), -1)
+    noise = rng.normal(0, 4, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+def test_otsu_thresholds():
+    rng = np.random.RandomState(0)
+    imgs = [rng.randint(0, 256, (50, 60)).astype(np.uint8),
+            np.concatenate([rng.normal(60, 10, 500), rng.normal(200, 15, 1500)]).clip(0, 255).astype(np.uint8)[None],
+            np.full((5, 5), 7, np.uint8)]
+    hist = [np.bincount(img.ravel(), minlength=256) for img in imgs]
+    expected = [cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[0] for img in imgs]
+    assert list(otsu_thresholds(hist)) == expected
+
+
+def test_label_histograms():
+    img = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    labels = np.array([[0, 1, 1, 2], [0, 1, 2, 2], [0, 0, 0, 2]])
+    hist = label_histograms(img, labels)
+    assert hist.shape == (3, 256)
+    assert not hist[0].any()
+    assert list(np.flatnonzero(hist[1])) == [1, 2, 5]
+    assert list(np.flatnonzero(hist[2])) == [3, 6, 7, 11]
+
+
+def test_engines_agree():
+    gray = make_scan()
+    roi = scanner.analyse_scan(gray)
+    labels = scanner.analyse_scan(gray, dict(engine = "labels"))
+    assert len(roi) == len(labels) == 6
+    for a, b in zip(sorted(roi, key=lambda r: (r['Y'], r['X'])), sorted(labels, key=lambda r: (r['Y'], r['X']))):
+        assert abs(a['X'] - b['X']) <= 3 and abs(a['Y'] - b['Y']) <= 3
+        assert b['length'] == pytest.approx(a['length'], rel=0.03)
+        assert b['area'] == pytest.approx(a['area'], rel=0.05)
+        assert b['mean'] == pytest.approx(a['mean'], abs=2)
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        scanner.analyse_scan(make_scan(), dict(engine = "label"))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+DirectoryWatcher (iso_cv/watch.py) - files are reported once, only when
+they are completely written (also if the writer stalls), and soon after
+"""
+
+import time
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+from iso_cv.watch import DirectoryWatcher, file_complete, ingest_camera, run_pipeline
+
+
+def jpeg_bytes(seed=0):
+    img = np.random.RandomState(seed).randint(0, 256, (200, 300)).astype(np.uint8)
+    return cv2.imencode(".jpg", img)[1].tobytes()
+
+
+def wait_for(watcher, timeout=3.0):
+    # poll until something is reported - returns (paths, seconds)
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        ready = watcher.poll()
+        if ready:
+            return ready, time.perf_counter() - start
+        time.sleep(watcher.interval)
+    return [], timeout
+
+
+def test_file_complete(tmp_path):
+    data = jpeg_bytes()
+    path = str(tmp_path / "a.jpg")
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    assert not file_complete(path)
+    with open(path, 'wb') as f:
+        f.write(data + b'\x00' * 10)
+    assert file_complete(path)
+    other = str(tmp_path / "a.tif")
+    with open(other, 'wb') as f:
+        f.write(b'abc')
+    assert file_complete(other)
+    assert not file_complete(str(tmp_path / "missing.jpg"))
+
+
+def test_stalled_writer_is_held_back(tmp_path):
+    watcher = DirectoryWatcher(str(tmp_path), backend = "poll", settle = 0.1, interval = 0.02)
+    data = jpeg_bytes()
+    path = str(tmp_path / "a.jpg")
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    # size and mtime stay the same for several times settle
+    ready, seconds = wait_for(watcher, timeout = 0.6)
+    assert ready == []
+    with open(path, 'ab') as f:
+        f.write(data[len(data) // 2:])
+    ready, seconds = wait_for(watcher)
+    assert ready == [path]
+    assert wait_for(watcher, timeout = 0.3)[0] == []
+
+
+def test_growing_file_is_held_back(tmp_path):
+    # a format without end marker: only the size has to settle
+    watcher = DirectoryWatcher(str(tmp_path), extensions = (".tif",), backend = "poll", settle = 0.2, interval = 0.02)
+    path = str(tmp_path / "a.tif")
+    start = time.perf_counter()
+    with open(path, 'wb') as f:
+        for i in range(5):
+            f.write(b'x' * 1000)
+            f.flush()
+            assert watcher.poll() == []
+            time.sleep(0.05)
+    ready, seconds = wait_for(watcher)
+    assert ready == [path]
+    assert time.perf_counter() - start >= 0.2
+
+
+@pytest.mark.parametrize("existing", [True, False])
+def test_latency(tmp_path, existing):
+    # a new image is reported well within a second of being written
+    with open(str(tmp_path / "old.jpg"), 'wb') as f:
+        f.write(jpeg_bytes(1))
+    watcher = DirectoryWatcher(str(tmp_path), backend = "poll", existing = existing)
+    if existing:
+        assert wait_for(watcher)[0] == [str(tmp_path / "old.jpg")]
+    path = str(tmp_path / "new.jpg")
+    with open(path, 'wb') as f:
+        f.write(jpeg_bytes(2))
+    ready, seconds = wait_for(watcher)
+    assert ready == [path]
+    assert seconds < watcher.settle + 5 * watcher.interval + 0.2
+
+
+def test_run_pipeline():
+    results = list(run_pipeline(range(20), [(lambda x: x + 1, 2), lambda x: 10 // (x - 5)], maxsize = 2))
+    assert sorted(r.item for r in results) == list(range(20))
+    failed = [r.item for r in results if r.error]
+    assert failed == [4]
+    assert all(r.value == 10 // (r.item - 4) for r in results if not r.error)
+
+
+def test_ingest_close_on_idle_directory(tmp_path):
+    # closing the generator (e.g. KeyboardInterrupt) without a stop event
+    # must return while no further image arrives
+    for d in ("in", "gray", "out"):
+        (tmp_path / d).mkdir()
+    with open(str(tmp_path / "in" / "a.jpg"), 'wb') as f:
+        f.write(jpeg_bytes())
+    ingest = ingest_camera(str(tmp_path / "in"), str(tmp_path / "gray"), str(tmp_path / "out"),
+                           str(tmp_path / "out" / "camera.txt"), backend = "poll", interval = 0.02, settle = 0.05)
+    assert next(ingest).item == str(tmp_path / "in" / "a.jpg")
+    closer = threading.Thread(target = ingest.close, daemon = True)
+    closer.start()
+    closer.join(5)
+    assert not closer.is_alive()